@@ -1,15 +1,53 @@
-import os
-
-SECRET_KEY = os.urandom(512)
+# Signs session cookies, so it must be the same in every worker and across
+# restarts. Generate one once, e.g. python -c "import secrets; print(secrets.token_hex(64))"
+SECRET_KEY = "SECRET KEY" # this needs to be provided
 
 DICE_API_NAME = "mapp"
 DICE_API_KEY = "PASSWORD" # this needs to be provided
 
+# CoSign check service; point this at tools/cosign_standin.py for local testing
+COSIGN_CHECK_URL = "http://bi:6663/check/"
+COSIGN_CACHE_TTL = 60 # seconds a validated cookie is trusted for
+COSIGN_TIMEOUT = (1, 3) # (connect, read) seconds
+
 LDAP_SERVER = "ldap://dir.inf.ed.ac.uk"
 
+# Maximum concurrent LDAP connections / CoSign checks per worker. Requests
+# beyond this wait for a slot (the mapp_limiter_* metrics show how often they do).
+LDAP_CONCURRENCY = 10
+COSIGN_CONCURRENCY = 10
+
 REDIS_URL = "redis://:PASSWORD@localhost:6379/0"
 
 DEBUG = True
 
+# Push room updates to browsers over Server-Sent Events (/api/events).
+# Every open stream holds a connection, so only enable this with gevent workers.
+SSE_ENABLED = False
+
+# How machine state is kept in redis: "hash" (one hash per machine) or
+# "compact" (one hash per room, much smaller). To switch, change this and run
+# `flask migrate-machine-store <old format>`.
+MACHINE_STORE = "hash"
+
+# Occupancy history: raw samples kept per room, and the least seconds between
+# samples (rollups to 5 minute, hourly and daily buckets are kept regardless).
+HISTORY_SAMPLES = 1440
+HISTORY_INTERVAL = 60
+
+# Compress responses with brotli (if installed) or gzip when the client accepts it.
+# Turn off if a proxy in front of the app already compresses.
+COMPRESS_RESPONSES = True
+
+# Seconds each worker caches the authorised callback keys for, i.e. the
+# longest a revoked key keeps working.
+API_KEY_CACHE_TTL = 60
+
+# Machines per redis pipeline when applying pushes (/api/update and /api/update/bulk).
+INGEST_BATCH_SIZE = 500
+
+# If set, /metrics (Prometheus) requires "Authorization: Bearer <token>".
+METRICS_TOKEN = None
+
 CRYPTO_SECRET="SECRET KEY"
 #CRYPTO_SECRET="Done this to invalidate old data"
@@ -0,0 +1,66 @@
+import os
+
+bind = "0.0.0.0:9000"
+
+workers = int(os.environ.get("GUNICORN_WORKERS", 1))
+
+# "sync" (the default) handles one request per worker at a time.
+# "gevent" serves many requests per worker, overlapping their redis, LDAP and
+# CoSign I/O; it is required for Server-Sent Events (SSE_ENABLED).
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "sync")
+
+# Concurrent connections per gevent worker. Each open SSE stream holds one.
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 500))
+
+# Import the app once in the master and warm its caches there, so workers
+# are forked ready to serve and share that memory. Set GUNICORN_PRELOAD=0 to
+# have each worker import the app and warm up by itself instead.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+if preload_app and worker_class == "gevent":
+    # the app is imported before any worker exists, so patch before it is
+    from gevent import monkey
+    monkey.patch_all()
+
+
+# Prometheus metrics from every worker are shared through files in this
+# directory, so /metrics reports totals whichever worker answers it.
+metrics_dir = os.environ.setdefault("prometheus_multiproc_dir", "/tmp/mapp-metrics")
+
+
+def on_starting(server):
+    # stale files from a previous run would be added to the new totals
+    import shutil
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def warm_up(log):
+    from map.warmup import warm_up
+    try:
+        summary = warm_up()
+    except Exception as e:
+        # a cold start is slower, not broken
+        log.warning("Warm-up failed: %s", e)
+        return
+    log.info("Warmed up %(sites)d sites, %(rooms)d rooms, %(templates)d templates, "
+             "%(people)d people and %(names)d names in %(seconds).2fs", summary)
+
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        warm_up(server.log)
+
+
+def post_worker_init(worker):
+    # runs after gevent has patched the worker, before it accepts a request
+    if worker.cfg.preload_app:
+        import map
+        map.after_fork()
+    else:
+        warm_up(worker.log)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
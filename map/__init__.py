@@ -1,23 +1,77 @@
-from flask import Flask, g
+import time
+
+from flask import Flask, g, request
 from flask_redis import FlaskRedis
 from flask_login import LoginManager
 from flask.sessions import SecureCookieSessionInterface
 from ldappool import ConnectionManager
 
+from . import concurrency, metrics, wire
+from .apikeys import ApiKeys
+from .assets import Assets
+from .concurrency import Limiter
 from .cosign import CoSign
+from .directory import Directory
+from .friendsview import FriendsView
+from .hashindex import HashIndex
+from .history import History
+from .machinestore import STORES
+from .occupants import OccupantIndex
+from .roomcounts import RoomCounts
+from .schema import Schema
+from .versions import Versions
+from .redistools import CountingRedis
 from .ldaptools import LDAPTools
+from .namecache import NameCache
 from werkzeug.contrib.fixers import ProxyFix
 
 app = Flask(__name__)
 app.config.from_object('config')
 app.wsgi_app = ProxyFix(app.wsgi_app)
+assets = Assets(app)
+
+def ldap_connections():
+    return ConnectionManager(app.config["LDAP_SERVER"], size=app.config.get("LDAP_CONCURRENCY", 10))
 
-flask_redis = FlaskRedis(app, 'REDIS', decode_responses=True)
+flask_redis = FlaskRedis.from_custom_provider(CountingRedis, app, decode_responses=True)
 ldap = LDAPTools(
-    ConnectionManager(app.config["LDAP_SERVER"])
+    ldap_connections(),
+    NameCache(flask_redis),
+    Limiter("ldap", app.config.get("LDAP_CONCURRENCY", 10))
 )
 
-cosign = CoSign(app, flask_redis)
+directory = Directory(flask_redis, ldap, app.config.get("DIRECTORY_MAX_AGE", 24*60*60))
+
+cosign = CoSign(app, flask_redis, Limiter("cosign", app.config.get("COSIGN_CONCURRENCY", 10)))
+
+uun_hashes = HashIndex(flask_redis, app.config["CRYPTO_SECRET"])
+occupants = OccupantIndex(flask_redis)
+room_counts = RoomCounts(flask_redis)
+versions = Versions(flask_redis)
+friends_views = FriendsView(flask_redis)
+history = History(flask_redis, app.config.get("HISTORY_SAMPLES", 1440), app.config.get("HISTORY_INTERVAL", 60))
+schema = Schema(flask_redis)
+api_keys = ApiKeys(flask_redis, app.config.get("API_KEY_CACHE_TTL", 60))
+machine_store = STORES[app.config.get("MACHINE_STORE", "hash")](flask_redis, schema)
+
+
+def after_fork():
+    """
+    Gives a newly forked worker connections and locks of its own.
+
+    With gunicorn --preload the app is imported once in the master and its
+    caches are inherited by every worker, but sockets opened in the master
+    would be shared between them, and under gevent anything that waits must
+    be made after patching.
+    """
+    # reset, not disconnect: shutting down the inherited sockets would cut off the master
+    flask_redis.connection_pool.reset()
+    ldap.cm = ldap_connections()
+    ldap.limiter.reset()
+    cosign.connect()
+    cosign.limiter.reset()
+    concurrency.after_fork()
+
 
 lm = LoginManager(app)
 lm.login_view = "login"
@@ -30,6 +84,32 @@ class CustomSessionInterface(SecureCookieSessionInterface):
 
 app.session_interface = CustomSessionInterface()
 
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def report_redis_roundtrips(response):
+    response.headers['X-Redis-Roundtrips'] = g.get('redis_roundtrips', 0)
+    return response
+
+@app.after_request
+def record_metrics(response):
+    if 'request_start' in g:
+        metrics.observe_request(
+            response,
+            time.perf_counter() - g.request_start,
+            g.get('redis_roundtrips', 0),
+            g.get('redis_commands', 0),
+            g.get('redis_seconds', 0))
+    return response
+
+@app.after_request
+def compress_response(response):
+    if app.config.get("COMPRESS_RESPONSES", True):
+        return wire.compress(request, response)
+    return response
+
 @lm.request_loader
 def get_user(request):
     print("request_loader: checking for session cookie...")
@@ -37,6 +117,6 @@ def get_user(request):
         print("request_loader: getting user via request_loader")
         return cosign.getuser(request.cookies['cosign-betterinformatics.com'], request.remote_addr)
 
-from . import views
+from . import views, commands
 
 app.jinja_env.globals.update(rooms_list=views.rooms_list)
@@ -0,0 +1,63 @@
+import time
+from threading import Lock
+
+
+class ApiKeys():
+    """
+    The callback keys mapp-worker and the schema tools authenticate with.
+
+    Keys live in the `authorised-key` redis list. Each process keeps a copy
+    for `ttl` seconds, so a push costs no round trip to check its key. An
+    unknown key reloads the list straight away (at most every `miss_interval`
+    seconds, so a client with a bad key can't hammer redis), so new keys work
+    at once, while a revoked key keeps working for up to `ttl` seconds in
+    other workers.
+    """
+
+    key = "authorised-key"
+
+    def __init__(self, flask_redis, ttl=60, miss_interval=1):
+        self.flask_redis = flask_redis
+        self.ttl = ttl
+        self.miss_interval = miss_interval
+
+        self.keys = None
+        self.loaded = 0
+        self.lock = Lock()
+
+    def _load(self, now):
+        keys = frozenset(self.flask_redis.lrange(self.key, 0, -1))
+        with self.lock:
+            self.keys = keys
+            self.loaded = now
+        return keys
+
+    def check(self, key):
+        """True if key is an authorised API key"""
+        if not key:
+            return False
+
+        now = time.time()
+        with self.lock:
+            keys, loaded = self.keys, self.loaded
+
+        if keys is None or loaded + self.ttl < now:
+            keys = self._load(now)
+        elif key not in keys and loaded + self.miss_interval < now:
+            keys = self._load(now)
+
+        return key in keys
+
+    def invalidate(self):
+        with self.lock:
+            self.keys = None
+
+    def add(self, key):
+        self.flask_redis.rpush(self.key, key)
+        self.invalidate()
+
+    def revoke(self, key):
+        """Removes key; returns whether it was there"""
+        removed = self.flask_redis.lrem(self.key, 0, key)
+        self.invalidate()
+        return bool(removed)
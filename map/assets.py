@@ -0,0 +1,99 @@
+import json
+import mimetypes
+import os
+
+from flask import url_for
+from werkzeug.http import parse_accept_header
+from werkzeug.wsgi import FileWrapper
+
+# fingerprinted names change with their content, so they never go stale
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+# precompressed copies written by tools/build_static.py, best first
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+class Assets():
+    """
+    Fingerprinted static files, built into static/dist/ by
+    tools/build_static.py.
+
+    Templates link to assets with static_url(filename), which gives the
+    fingerprinted copy's URL from the build's manifest. Those URLs are
+    answered by StaticFiles in front of the app, so serving them never
+    touches Flask, CoSign or redis. Without a build (e.g. in development)
+    static_url falls back to the plain static route.
+    """
+
+    directory = "dist"
+
+    def __init__(self, app):
+        self.root = os.path.join(app.static_folder, self.directory)
+        self.url_path = "%s/%s/" % (app.static_url_path, self.directory)
+
+        try:
+            with open(os.path.join(self.root, "manifest.json")) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {}
+
+        app.jinja_env.globals['static_url'] = self.url
+        if self.manifest:
+            app.wsgi_app = StaticFiles(app.wsgi_app, self.root, self.url_path, self.manifest.values())
+
+    def url(self, filename):
+        fingerprinted = self.manifest.get(filename)
+        if fingerprinted is None:
+            return url_for('static', filename=filename)
+        return self.url_path + fingerprinted
+
+
+class StaticFiles():
+    """
+    WSGI middleware serving a fixed set of files under a URL prefix
+    straight from disk, with year-long immutable caching and the smallest
+    precompressed copy the client accepts. Anything else goes on to the app.
+    """
+
+    chunk_size = 64*1024
+
+    def __init__(self, app, root, prefix, names):
+        self.app = app
+        self.prefix = prefix
+
+        # name -> [(encoding or None, path, size)], looked up once so
+        # requests never build paths from the URL
+        self.files = {}
+        for name in names:
+            path = os.path.join(root, name)
+            variants = [(encoding, path + suffix) for encoding, suffix in ENCODINGS] + [(None, path)]
+            self.files[name] = [
+                (encoding, variant, os.path.getsize(variant))
+                for encoding, variant in variants
+                if os.path.exists(variant)
+            ]
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        variants = self.files.get(path[len(self.prefix):]) if path.startswith(self.prefix) else None
+        if not variants or environ['REQUEST_METHOD'] not in ("GET", "HEAD"):
+            return self.app(environ, start_response)
+
+        accepted = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))
+        encoding, variant, size = next(v for v in variants if v[0] is None or accepted[v[0]])
+
+        content_type, _ = mimetypes.guess_type(path)
+        headers = [
+            ('Content-Type', content_type or "application/octet-stream"),
+            ('Content-Length', str(size)),
+            ('Cache-Control', IMMUTABLE),
+            ('Vary', "Accept-Encoding"),
+        ]
+        if encoding:
+            headers.append(('Content-Encoding', encoding))
+        start_response("200 OK", headers)
+
+        if environ['REQUEST_METHOD'] == "HEAD":
+            return []
+        wrapper = environ.get('wsgi.file_wrapper', FileWrapper)
+        return wrapper(open(variant, "rb"), self.chunk_size)
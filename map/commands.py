@@ -0,0 +1,96 @@
+import click
+
+from map import app, api_keys, cosign, directory, flask_redis, machine_store, occupants, room_counts, schema, uun_hashes
+from . import machinestore
+from .sitedata import get_sites
+
+
+@app.cli.command("rebuild-hash-index")
+def rebuild_hash_index():
+    """Adds every friend and cascader to the uun hash index for the current CRYPTO_SECRET."""
+    count = uun_hashes.rebuild()
+    if count is None:
+        raise click.ClickException("The index is already being rebuilt")
+    click.echo("Indexed %d uuns" % count)
+
+
+@app.cli.command("rebuild-occupants")
+def rebuild_occupants():
+    """Rebuilds the occupant index from the current state of every site."""
+    count = occupants.rebuild(get_sites())
+    click.echo("Indexed %d occupied machines" % count)
+
+
+@app.cli.command("rebuild-room-counts")
+def rebuild_room_counts():
+    """Recounts free, used and offline machines and cascaders in every room."""
+    count = room_counts.rebuild()
+    click.echo("Counted %d rooms" % count)
+
+
+@app.cli.command("ban")
+@click.argument("uun")
+def ban(uun):
+    """Bans a user, dropping any cached logins they have."""
+    cosign.ban(uun)
+    click.echo("Banned %s" % uun)
+
+
+@app.cli.command("unban")
+@click.argument("uun")
+def unban(uun):
+    """Unbans a user, dropping any cached logins they have."""
+    cosign.unban(uun)
+    click.echo("Unbanned %s" % uun)
+
+
+@app.cli.command("add-api-key")
+@click.argument("key")
+def add_api_key(key):
+    """Authorises KEY for /api/update, /api/update/bulk and /api/update_schema."""
+    api_keys.add(key)
+    click.echo("Added key")
+
+
+@app.cli.command("revoke-api-key")
+@click.argument("key")
+def revoke_api_key(key):
+    """Revokes KEY. Workers stop accepting it within API_KEY_CACHE_TTL seconds."""
+    if not api_keys.revoke(key):
+        raise click.ClickException("No such key")
+    click.echo("Revoked key")
+
+
+@app.cli.command("refresh-directory")
+def refresh_directory():
+    """Refreshes the local People OU snapshot used by /api/search."""
+    count = directory.refresh()
+    click.echo("Loaded %d people" % count)
+
+
+@app.cli.command("warm-up")
+def warm_up():
+    """Runs the warm-up workers do before serving, filling the shared name cache."""
+    from .warmup import warm_up
+    summary = warm_up()
+    click.echo("Warmed up %(sites)d sites, %(rooms)d rooms, %(templates)d templates, "
+               "%(people)d people and %(names)d names in %(seconds).2fs" % summary)
+
+
+@app.cli.command("migrate-schema")
+def migrate_schema():
+    """Moves sites stored in older layouts into site-tagged schema generations."""
+    for site in schema.sites():
+        if schema.generation(site) is None:
+            count = schema.migrate(site)
+            click.echo("Migrated %d rooms of %s" % (count, site))
+
+
+@app.cli.command("migrate-machine-store")
+@click.argument("source", type=click.Choice(sorted(machinestore.STORES)))
+def migrate_machine_store(source):
+    """Moves machine state from SOURCE into the configured MACHINE_STORE."""
+    if source == machine_store.name:
+        raise click.UsageError("%s is already the configured store" % source)
+    count = machinestore.migrate(flask_redis, schema, machinestore.STORES[source](flask_redis, schema), machine_store)
+    click.echo("Moved %d machines from %s to %s" % (count, source, machine_store.name))
@@ -0,0 +1,111 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import metrics
+
+
+def cooperative():
+    """True when running on gevent workers (gunicorn -k gevent patches the stdlib)"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("socket")
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def executor(max_workers=10):
+    """
+    Returns the process-wide pool used to run blocking calls off the request.
+
+    Under gevent the standard threading module is patched into greenlets, and
+    python-ldap would block the whole hub, so gevent's pool of real threads
+    is used instead.
+    """
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            if cooperative():
+                from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+                _executor = GeventThreadPoolExecutor(max_workers=max_workers)
+            else:
+                _executor = ThreadPoolExecutor(max_workers=max_workers)
+        return _executor
+
+
+def after_fork():
+    """
+    Forgets the executor in a newly forked worker. Its threads were not
+    copied by the fork, and under gevent it must be made after patching.
+    """
+    global _executor, _executor_lock
+
+    _executor = None
+    _executor_lock = threading.Lock()
+
+
+def submit(fn, *args, **kwargs):
+    """
+    Starts fn(*args, **kwargs) in the background, returning a future.
+
+    Its LDAP and CoSign calls are counted against the endpoint that started it.
+    """
+    endpoint = metrics.current_endpoint()
+
+    def run():
+        with metrics.endpoint(endpoint):
+            return fn(*args, **kwargs)
+
+    return executor().submit(run)
+
+
+class Limiter():
+    """
+    Bounds how many calls to a dependency are in flight at once.
+
+    It also measures the calls as the mapp_limiter_* metrics: current and
+    peak in flight, and how long callers waited for a slot. That shows
+    whether the limit is too tight (lots of waiting) or can safely be
+    lowered (peak well under it).
+    """
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.reset()
+
+    def reset(self):
+        """Starts afresh with new locks and no calls in flight, e.g. in a newly forked worker"""
+        self.semaphore = threading.BoundedSemaphore(self.limit)
+        self.lock = threading.Lock()
+
+        self.in_flight = 0
+        self.peak = 0
+
+        metrics.limiter_limit.labels(self.name).set(self.limit)
+
+    def __enter__(self):
+        start = time.time()
+        self.semaphore.acquire()
+        waited = time.time() - start
+
+        with self.lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            peak = self.peak
+
+        metrics.limiter_wait_seconds.labels(self.name).observe(waited)
+        metrics.limiter_in_flight.labels(self.name).inc()
+        metrics.limiter_peak.labels(self.name).set(peak)
+        return self
+
+    def __exit__(self, *exc):
+        with self.lock:
+            self.in_flight -= 1
+        metrics.limiter_in_flight.labels(self.name).dec()
+        self.semaphore.release()
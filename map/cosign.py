@@ -1,4 +1,11 @@
+import hashlib
+import json
+from contextlib import nullcontext
+
 import requests
+from requests.adapters import HTTPAdapter
+
+from .metrics import cosign_cache, cosign_seconds, current_endpoint, timed
 from .user import User, DisabledUser
 
 
@@ -7,28 +14,108 @@ class ServerDownException(Exception):
 
 
 class CoSign():
-    def __init__(self, app, flask_redis):
+    """
+    Validates CoSign cookies against the check service.
+
+    Results are cached in redis (so every gunicorn worker shares them) for
+    COSIGN_CACHE_TTL seconds, keyed on the cookie and client IP. Cached
+    entries are dropped on logout and when a user is banned or unbanned.
+    """
+
+    cache_prefix = "cosign."
+
+    def __init__(self, app, flask_redis, limiter=None):
         self.config = {
             "name": app.config["DICE_API_NAME"],
-            "key": app.config["DICE_API_KEY"]
+            "key": app.config["DICE_API_KEY"],
+            "check_url": app.config.get("COSIGN_CHECK_URL", "http://bi:6663/check/"),
+            "cache_ttl": app.config.get("COSIGN_CACHE_TTL", 60),
+            "timeout": app.config.get("COSIGN_TIMEOUT", (1, 3)),
         }
 
         self.flask_redis = flask_redis
+        self.logger = app.logger
+
+        # optional Limiter bounding concurrent checks
+        self.limiter = limiter
+        self.pool_size = limiter.limit if limiter else 10
+        self.connect()
+
+    def connect(self):
+        """Starts a new pool of connections to the check service, e.g. in a newly forked worker"""
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=self.pool_size))
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=self.pool_size))
+
+    def cache_key(self, login_token, ip):
+        digest = hashlib.sha256((login_token + "|" + str(ip)).encode("utf-8")).hexdigest()
+        return self.cache_prefix + digest
+
+    def user_key(self, uun):
+        return self.cache_prefix + "user." + uun
+
+    def check(self, login_token, ip):
+        """Asks the check service about a cookie, returning its decoded response"""
+        payload = {'cookie': login_token, 'ip': ip}
+        url = self.config['check_url'] + self.config['name'] + "/" + self.config['key']
+        with self.limiter or nullcontext(), timed(cosign_seconds):
+            r = self.session.get(url, params=payload, timeout=self.config['timeout'])
+        return r.json()
+
+    def validate(self, login_token, ip):
+        """Returns (check response, banned), from the cache if possible"""
+        key = self.cache_key(login_token, ip)
+
+        cached = self.flask_redis.get(key)
+        if cached is not None:
+            cosign_cache.labels(current_endpoint(), "hit").inc()
+            entry = json.loads(cached)
+            return entry['check'], entry['banned']
+
+        cosign_cache.labels(current_endpoint(), "miss").inc()
+
+        obj = self.check(login_token, ip)
+
+        banned = False
+        pipe = self.flask_redis.pipeline()
+        if obj['status'] == 'success':
+            uun = obj['data']['Principal']
+            banned = self.flask_redis.sismember("bannedusers", uun)
+
+            pipe.sadd(self.user_key(uun), key)
+            pipe.expire(self.user_key(uun), self.config['cache_ttl'])
+        pipe.setex(key, self.config['cache_ttl'], json.dumps({'check': obj, 'banned': banned}))
+        pipe.execute()
+
+        return obj, banned
 
     def getuser(self, login_token, ip):
-        #try:
-            payload = {'cookie': login_token, 'ip': ip}
-            r = requests.get("http://bi:6663/check/" + self.config['name'] + "/" + self.config['key'], params=payload)
-            obj = r.json()
-
-            # print(obj)
-            if obj['status'] == 'success' and obj['data']['Realm'] == 'INF.ED.AC.UK':
-                banned = self.flask_redis.sismember("bannedusers", obj['data']['Principal'])
-                if not banned:
-                    return User(login_token, obj['data'])
-
-            if obj['status'] == 'success':
-                return DisabledUser(login_token, obj['data'])
-
-        #except Exception:
-        #    print("Ran into exception in getuser")
+        try:
+            obj, banned = self.validate(login_token, ip)
+        except (requests.RequestException, ValueError) as e:
+            self.logger.warning("CoSign check failed in getuser: %s", e)
+            return None
+
+        if obj['status'] == 'success' and obj['data']['Realm'] == 'INF.ED.AC.UK':
+            if not banned:
+                return User(login_token, obj['data'])
+
+        if obj['status'] == 'success':
+            return DisabledUser(login_token, obj['data'])
+
+    def invalidate(self, login_token, ip):
+        """Forgets the cached check for a cookie, e.g. on logout"""
+        self.flask_redis.delete(self.cache_key(login_token, ip))
+
+    def invalidate_user(self, uun):
+        """Forgets every cached check for a user"""
+        keys = self.flask_redis.smembers(self.user_key(uun))
+        self.flask_redis.delete(self.user_key(uun), *keys)
+
+    def ban(self, uun):
+        self.flask_redis.sadd("bannedusers", uun)
+        self.invalidate_user(uun)
+
+    def unban(self, uun):
+        self.flask_redis.srem("bannedusers", uun)
+        self.invalidate_user(uun)
@@ -0,0 +1,137 @@
+import json
+import threading
+import time
+from collections import namedtuple
+
+# everything a search reads, swapped in as one, so a search running while
+# a refresh finishes never mixes the old index with the new people
+Snapshot = namedtuple("Snapshot", ("people", "by_uid", "index"))
+
+
+def ngrams(text, n=2):
+    return {text[i:i+n] for i in range(len(text) - n + 1)}
+
+
+class Directory():
+    """
+    Local, indexed snapshot of the People OU for /api/search.
+
+    The snapshot (every uid and display name) is fetched from LDAP at most
+    every `max_age` seconds, stored in redis for every worker to share and
+    loaded into memory with a bigram index, so a search is a few set
+    intersections instead of a leading-wildcard LDAP query.
+
+    While the snapshot is missing or stale, `search` returns None so callers
+    can fall back to LDAP, and a refresh is started in the background.
+    """
+
+    snapshot_key = "directory.snapshot"
+    updated_key = "directory.updated"
+    lock_key = "directory.lock"
+
+    def __init__(self, flask_redis, ldap, max_age=24*60*60, check_interval=60):
+        self.flask_redis = flask_redis
+        self.ldap = ldap
+        self.max_age = max_age
+        self.check_interval = check_interval
+
+        self.updated = 0
+        self.checked = 0
+
+        self.snapshot = Snapshot([], {}, {})
+
+    def refresh(self):
+        """Fetches the People OU from LDAP and publishes it to every worker"""
+        people = sorted(self.ldap.list_people(), key=lambda p: p[1].lower())
+        updated = time.time()
+
+        pipe = self.flask_redis.pipeline()
+        pipe.set(self.snapshot_key, json.dumps(people))
+        pipe.set(self.updated_key, updated)
+        pipe.execute()
+
+        self.build(people, updated)
+        return len(people)
+
+    def refresh_in_background(self):
+        """Refreshes the snapshot in a thread, unless another worker already is"""
+        from map import app
+
+        if not self.flask_redis.set(self.lock_key, 1, nx=True, ex=10*60):
+            return
+
+        def run():
+            try:
+                self.refresh()
+            except Exception as e:
+                app.logger.warning("Failed to refresh directory snapshot: %s", e)
+            finally:
+                self.flask_redis.delete(self.lock_key)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def build(self, people, updated):
+        index = {}
+        by_uid = {}
+        for i, (uid, name) in enumerate(people):
+            by_uid[uid.lower()] = i
+            for gram in ngrams(name.lower()):
+                index.setdefault(gram, set()).add(i)
+
+        self.snapshot = Snapshot([(uid, name, name.lower()) for uid, name in people], by_uid, index)
+        self.updated = updated
+
+    def load(self):
+        """Loads the snapshot from redis, if it is newer than the one in memory"""
+        updated = float(self.flask_redis.get(self.updated_key) or 0)
+        if updated > self.updated:
+            blob = self.flask_redis.get(self.snapshot_key)
+            if blob is not None:
+                self.build(json.loads(blob), updated)
+
+    def sync(self):
+        """Loads a newer snapshot from redis, checking at most every check_interval seconds"""
+        now = time.time()
+        if now - self.checked < self.check_interval:
+            return
+        self.checked = now
+
+        self.load()
+        if now - self.updated > self.max_age:
+            self.refresh_in_background()
+
+    def is_fresh(self):
+        return time.time() - self.updated <= self.max_age
+
+    def search(self, query, limit=50):
+        """
+        Returns up to `limit` people whose name contains `query` or whose uun
+        is `query`, best matches first, or None if the snapshot is stale.
+        """
+        self.sync()
+        if not self.is_fresh():
+            return None
+
+        people, by_uid, index = self.snapshot
+
+        needle = query.lower()
+        grams = sorted((index.get(gram, set()) for gram in ngrams(needle)), key=len)
+        candidates = set.intersection(*grams) if grams else set()
+
+        def rank(i):
+            uid, name, lower = people[i]
+            if uid.lower() == needle:
+                return (0, lower)
+            if lower.startswith(needle):
+                return (1, lower)
+            if (" " + needle) in lower:
+                return (2, lower)
+            return (3, lower)
+
+        matches = {i for i in candidates if needle in people[i][2]}
+        if needle in by_uid:
+            matches.add(by_uid[needle])
+
+        matches = sorted(matches, key=rank)
+
+        return [{'uun': people[i][0], 'name': people[i][1]} for i in matches[:limit]]
@@ -0,0 +1,47 @@
+import json
+import time
+
+CHANNEL_PREFIX = "room-updates."
+
+
+def channel(room_key):
+    return CHANNEL_PREFIX + room_key
+
+
+def publish_room_updates(pipe, room_keys, last_update):
+    """Queues a notification on each room's channel that its state has changed"""
+    for room_key in room_keys:
+        pipe.publish(channel(room_key), json.dumps({
+            'room': room_key,
+            'last_update': last_update,
+        }))
+
+
+def sse(event, data):
+    return "event: %s\ndata: %s\n\n" % (event, data)
+
+
+def room_events(flask_redis, room_key, heartbeat=25, max_age=5*60):
+    """
+    Generates a Server-Sent Events stream of updates to a room.
+
+    A comment is sent every `heartbeat` seconds to keep proxies from closing
+    the connection, and the stream ends after `max_age` seconds so that
+    long-lived connections are spread over workers (EventSource reconnects
+    on its own).
+    """
+    pubsub = flask_redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(channel(room_key))
+
+    try:
+        yield "retry: 5000\n\n"
+
+        deadline = time.time() + max_age
+        while time.time() < deadline:
+            message = pubsub.get_message(timeout=heartbeat)
+            if message is None:
+                yield ": keepalive\n\n"
+            elif message['type'] == 'message':
+                yield sse("update", message['data'])
+    finally:
+        pubsub.close()
@@ -0,0 +1,124 @@
+import json
+
+
+class FriendsView():
+    """
+    Each user's friends list, ready to serve.
+
+    `friends-view.<uun>` holds the list as JSON: every friend's uun, display
+    name, uun hash and sort key, already sorted, along with the version of
+    the user's friends (`friends.<uun>` in the versions hash) it was built
+    from. Adding and removing friends through here edits the view in place,
+    so serving the list is one round trip instead of a SMEMBERS, an LDAP
+    lookup of every name and a sort. A view that is behind its version, or
+    whose hashes are for an old CRYPTO_SECRET, is rebuilt when next read.
+    """
+
+    prefix = "friends-view."
+
+    def __init__(self, flask_redis):
+        self.flask_redis = flask_redis
+
+    def key(self, uun):
+        return self.prefix + uun
+
+    @staticmethod
+    def friends_key(uun):
+        return uun + "-friends"
+
+    @staticmethod
+    def version_field(uun):
+        return "friends." + uun
+
+    def entry(self, uun, name):
+        from map import uun_hashes
+
+        display = "%s (%s)" % (name or uun, uun)
+        return {'uun': uun, 'name': display, 'hash': uun_hashes.hash(uun), 'sort': display.lower()}
+
+    def get(self, uun):
+        """Returns (version, [friend entries sorted by name]) for a user"""
+        from map import versions
+
+        pipe = self.flask_redis.pipeline(transaction=False)
+        pipe.hget(versions.key, self.version_field(uun))
+        pipe.get(self.key(uun))
+        version, blob = pipe.execute()
+        version = int(version or 0)
+
+        view = self.current(blob, version)
+        if view is None:
+            view = self.rebuild(uun, version)
+        return version, view['friends']
+
+    def current(self, blob, version):
+        """The view in blob, if it is up to date with version"""
+        from map import uun_hashes
+
+        if blob is None:
+            return None
+        view = json.loads(blob)
+        if view['version'] != version or view['secret'] != uun_hashes.fingerprint:
+            return None
+        return view
+
+    def store(self, pipe, uun, version, friends):
+        from map import uun_hashes
+
+        friends.sort(key=lambda f: f['sort'])
+        view = {'version': version, 'secret': uun_hashes.fingerprint, 'friends': friends}
+        pipe.set(self.key(uun), json.dumps(view))
+        return view
+
+    def rebuild(self, uun, version):
+        from map import ldap
+
+        uuns = list(self.flask_redis.smembers(self.friends_key(uun)))
+        names = ldap.get_names(uuns)
+        return self.store(self.flask_redis, uun, version, [self.entry(friend, names.get(friend)) for friend in uuns])
+
+    def change(self, uun, add=(), remove=()):
+        """
+        Adds and removes friends of a user, bumping their version and
+        updating the view if any actually changed.
+        """
+        from map import ldap, uun_hashes, versions
+
+        add = [friend for friend in add if friend]
+        remove = [friend for friend in remove if friend]
+        if add:
+            uun_hashes.add(*add)
+
+        blob = None
+
+        def apply(pipe):
+            nonlocal blob
+            friends = pipe.smembers(self.friends_key(uun))
+            blob = pipe.get(self.key(uun))
+            if (friends | set(add)) - set(remove) == friends:
+                return
+
+            # the version moves with the friends, so if anything below fails
+            # the view is left behind it and rebuilt when next read
+            pipe.multi()
+            if add:
+                pipe.sadd(self.friends_key(uun), *add)
+            if remove:
+                pipe.srem(self.friends_key(uun), *remove)
+            versions.bump(pipe, self.version_field(uun))
+
+        changed = self.flask_redis.transaction(apply, self.friends_key(uun), self.key(uun))
+        if not changed:
+            return
+        version = changed[-1]
+
+        names = ldap.get_names(add) if add else {}
+
+        # edit the view in place if it was current before this change,
+        # otherwise leave it to be rebuilt when next read
+        view = self.current(blob, version - 1)
+        if view is not None:
+            gone = set(add) | set(remove)
+            friends = [f for f in view['friends'] if f['uun'] not in gone]
+            friends += [self.entry(friend, names.get(friend)) for friend in add if friend not in remove]
+            self.store(self.flask_redis, uun, version, friends)
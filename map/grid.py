@@ -0,0 +1,35 @@
+def empty_cell(row, col):
+    return {'hostname': None, 'col': col, 'row': row}
+
+
+def build_grid(machines):
+    """
+    Lays a room's machines out as rows of cells, filling gaps with empty cells.
+
+    Machines are indexed by (row, col) in a single pass, so the cost is
+    O(machines + cells) rather than a scan of every machine for every cell.
+    Rows without any machines are filled straight from empty cells.
+    """
+    by_row = {}
+    num_rows = 0
+    num_cols = 0
+
+    for machine in machines:
+        row = int(machine['row'])
+        col = int(machine['col'])
+
+        # the first machine listed at a coordinate wins
+        by_row.setdefault(row, {}).setdefault(col, machine)
+
+        num_rows = max(num_rows, row + 1)
+        num_cols = max(num_cols, col + 1)
+
+    rows = []
+    for r in range(num_rows):
+        cols = by_row.get(r)
+        if cols is None:
+            rows.append([empty_cell(r, c) for c in range(num_cols)])
+        else:
+            rows.append([cols.get(c) or empty_cell(r, c) for c in range(num_cols)])
+
+    return rows
@@ -0,0 +1,126 @@
+import hashlib
+
+from threading import Lock
+
+from flask import g, has_app_context
+
+
+def hash_uun(uun, secret):
+    """Returns the salted hash mapp-worker pushes in place of a uun"""
+    hasher = hashlib.sha512()
+    hasher.update((uun + str(secret)).encode("utf-8"))
+
+    return hasher.hexdigest()
+
+
+class HashIndex():
+    """
+    Reverse index of uun hash -> uun.
+
+    The index only needs to know about users we would ever want to name on
+    the map (friends and cascaders), so it is extended whenever one of those
+    is added. A hash is worked out from its uun, so the index is just the
+    list of uuns, `uun-hashes.<fingerprint>`, appended to as they are added.
+    Each process mirrors it in memory and keeps up by reading only the
+    entries appended since it last looked.
+
+    The fingerprint is of CRYPTO_SECRET, so rotating it starts a new index
+    rather than overwriting the old one, and workers on the old and new
+    secrets (e.g. mid deploy) each keep their own. A new index is built from
+    every friends list and cascader by whichever worker first needs it,
+    holding `uun-hashes.<fingerprint>.lock` so only one worker does;
+    `uun-hashes.<fingerprint>.built` marks it done. Indexes for old secrets
+    can be deleted once no worker uses them.
+    """
+
+    prefix = "uun-hashes."
+
+    # how long a rebuild may hold the lock
+    lock_ttl = 5*60
+
+    def __init__(self, flask_redis, secret):
+        self.flask_redis = flask_redis
+        self.secret = secret
+        self.fingerprint = hashlib.sha512(("uun-hashes" + str(secret)).encode("utf-8")).hexdigest()
+
+        self.index_key = self.prefix + self.fingerprint[:16]
+        self.built_key = self.index_key + ".built"
+        self.lock_key = self.index_key + ".lock"
+
+        self.hashes = {}
+        # how many entries of the list are in self.hashes
+        self.seen = 0
+        self.lock = Lock()
+
+    def hash(self, uun):
+        return hash_uun(uun, self.secret)
+
+    def add(self, *uuns):
+        """Adds uuns to the index, making them visible to every worker"""
+        if uuns:
+            self.flask_redis.rpush(self.index_key, *uuns)
+
+    def lookup(self, uun_hash):
+        """Returns the uun for a hash, or None if it is not one we know"""
+        if not uun_hash:
+            return None
+
+        self.sync()
+        return self.hashes.get(uun_hash)
+
+    def sync(self):
+        """Picks up uuns added to the index since it was last read (once per request)"""
+        if has_app_context():
+            if g.get("uun_hashes_synced"):
+                return
+            g.uun_hashes_synced = True
+
+        if not self.catch_up() and self.rebuild() is not None:
+            self.catch_up()
+
+    def catch_up(self):
+        """Reads the entries appended since the last read. Returns whether the index is built."""
+        seen = self.seen
+        pipe = self.flask_redis.pipeline(transaction=False)
+        pipe.exists(self.built_key)
+        pipe.lrange(self.index_key, seen, -1)
+        built, added = pipe.execute()
+
+        with self.lock:
+            # unless another thread got there first
+            if self.seen == seen:
+                self.hashes.update((self.hash(uun), uun) for uun in added)
+                self.seen = seen + len(added)
+
+        return bool(built)
+
+    def known_uuns(self):
+        """Every uun that belongs in the index: friends, people with friends and cascaders"""
+        uuns = set(self.flask_redis.smembers("cascaders.users"))
+        for key in self.flask_redis.scan_iter(match="*-friends"):
+            uuns.add(key[:-len("-friends")])
+            uuns.update(self.flask_redis.smembers(key))
+
+        return uuns
+
+    def rebuild(self):
+        """
+        Adds every known uun to the index for the current secret, unless
+        another worker is already doing so. Returns the number of uuns, or
+        None if it was left to the other worker.
+        """
+        if not self.flask_redis.set(self.lock_key, 1, nx=True, ex=self.lock_ttl):
+            return None
+
+        try:
+            uuns = self.known_uuns()
+
+            pipe = self.flask_redis.pipeline()
+            if uuns:
+                pipe.rpush(self.index_key, *sorted(uuns))
+            pipe.set(self.built_key, 1)
+            pipe.execute()
+        finally:
+            self.flask_redis.delete(self.lock_key)
+
+        return len(uuns)
@@ -0,0 +1,138 @@
+import time
+from collections import OrderedDict
+
+from .schema import tag
+
+STATS = ("free", "used", "offline")
+
+# rollup name -> (bucket width, how long buckets are kept), in seconds
+RESOLUTIONS = OrderedDict([
+    ("5m", (5*60, 7*24*60*60)),
+    ("1h", (60*60, 90*24*60*60)),
+    ("1d", (24*60*60, 2*365*24*60*60)),
+])
+
+
+class History():
+    """
+    Occupancy history of every room.
+
+    Each sample of a room's (free, used, offline) machine counts goes to:
+    - `history.{<site>}.<room>`, a list of the last `samples` raw samples,
+      packed as "time free used offline" and trimmed on every write;
+    - one `history.{<site>}.<room>.<resolution>.<bucket start>` hash per
+      5 minute, hour and day bucket, holding the number of samples and the
+      sum of each count, which expires once it falls out of its resolution's
+      retention;
+    - `history.{<site>}.<room>.weekly`, sums per weekday and hour (local
+      time) over all time, for questions like "how busy is 6.06 on Tuesday
+      afternoons".
+
+    Every write is an increment, so workers never need to coordinate, memory
+    is bounded, and a query reads one small hash per bucket no matter how
+    many samples went into it. Each room is sampled at most every `interval`
+    seconds, by whichever push reports it first (claiming
+    `history.{<site>}.<room>.sampled`), however often it is pushed.
+    """
+
+    prefix = "history."
+
+    def __init__(self, flask_redis, samples=1440, interval=60):
+        self.flask_redis = flask_redis
+        self.samples = samples
+        self.interval = interval
+
+    def samples_key(self, site, room_key):
+        return "%s%s.%s" % (self.prefix, tag(site), room_key)
+
+    def bucket_key(self, site, room_key, resolution, start):
+        return "%s.%s.%d" % (self.samples_key(site, room_key), resolution, start)
+
+    def profile_key(self, site, room_key):
+        return self.samples_key(site, room_key) + ".weekly"
+
+    def claim_key(self, site, room_key):
+        return self.samples_key(site, room_key) + ".sampled"
+
+    def due(self, rooms, now):
+        """
+        Claims the next sample of each (site, room key) that is due one,
+        returning those claimed. Each room is claimed by itself, so whichever
+        push (or worker, or site) reaches a room first samples it.
+        """
+        rooms = list(rooms)
+        pipe = self.flask_redis.pipeline(transaction=False)
+        for site, room_key in rooms:
+            pipe.set(self.claim_key(site, room_key), now, nx=True, ex=self.interval)
+        return [room for room, claimed in zip(rooms, pipe.execute()) if claimed]
+
+    def record(self, counts, now):
+        """Records a sample of {(site, room key): (free, used, offline)} taken at `now`"""
+        local = time.localtime(now)
+        profile = "%d.%d" % (local.tm_wday, local.tm_hour)
+
+        pipe = self.flask_redis.pipeline(transaction=False)
+        for (site, room_key), values in counts.items():
+            pipe.lpush(self.samples_key(site, room_key), "%d %d %d %d" % ((now,) + tuple(values)))
+            pipe.ltrim(self.samples_key(site, room_key), 0, self.samples - 1)
+
+            for resolution, (width, retention) in RESOLUTIONS.items():
+                start = int(now // width * width)
+                key = self.bucket_key(site, room_key, resolution, start)
+                pipe.hincrby(key, "samples", 1)
+                for stat, value in zip(STATS, values):
+                    pipe.hincrby(key, stat, value)
+                pipe.expireat(key, start + width + retention)
+
+            pipe.hincrby(self.profile_key(site, room_key), profile + ".samples", 1)
+            for stat, value in zip(STATS, values):
+                pipe.hincrby(self.profile_key(site, room_key), profile + "." + stat, value)
+        pipe.execute()
+
+    def recent(self, site, room_key, limit=None):
+        """Returns the latest raw samples, newest first"""
+        limit = self.samples if limit is None else min(limit, self.samples)
+        samples = self.flask_redis.lrange(self.samples_key(site, room_key), 0, limit - 1)
+
+        result = []
+        for sample in samples:
+            t, *values = sample.split(" ")
+            result.append(dict(zip(STATS, map(int, values)), time=int(t)))
+        return result
+
+    def rollup(self, site, room_key, resolution, start, end):
+        """
+        Returns the average counts in each bucket of `resolution` from start
+        to end (as unix times), skipping buckets with no samples.
+        """
+        width, _ = RESOLUTIONS[resolution]
+        starts = range(int(start // width * width), int(end) + 1, width)
+
+        pipe = self.flask_redis.pipeline(transaction=False)
+        for bucket in starts:
+            pipe.hgetall(self.bucket_key(site, room_key, resolution, bucket))
+
+        return [
+            averages(bucket, "", sums)
+            for bucket, sums in zip(starts, pipe.execute())
+            if sums
+        ]
+
+    def profile(self, site, room_key):
+        """Returns average counts for each weekday (0 is Monday) and hour"""
+        sums = self.flask_redis.hgetall(self.profile_key(site, room_key))
+        return [
+            dict(averages(None, "%d.%d." % (day, hour), sums), weekday=day, hour=hour)
+            for day in range(7)
+            for hour in range(24)
+            if "%d.%d.samples" % (day, hour) in sums
+        ]
+
+
+def averages(start, prefix, sums):
+    samples = int(sums[prefix + "samples"])
+    result = {stat: round(int(sums.get(prefix + stat, 0)) / samples, 2) for stat in STATS}
+    result['samples'] = samples
+    if start is not None:
+        result['time'] = start
+    return result
@@ -0,0 +1,291 @@
+import gzip
+import json
+import time
+from collections import OrderedDict
+from itertools import islice
+
+from .events import publish_room_updates
+from .snapshot import write_snapshots
+
+# fields mapp-worker reports for each machine
+FIELDS = ("user", "timestamp", "status")
+
+# fields that show up on the map; a change to any of these changes the room
+VISIBLE_FIELDS = ("user", "status")
+
+# bulk pushes are decompressed and parsed this many bytes at a time
+CHUNK_SIZE = 64*1024
+# the most a bulk push may decompress to, and the longest a single record may be
+MAX_PUSH_BYTES = 64*1024*1024
+MAX_RECORD_BYTES = 64*1024
+
+# how long a worker's last applied sequence number is remembered, and how
+# long a push in progress holds its claim
+SEQUENCE_TTL = 24*60*60
+CLAIM_TTL = 5*60
+
+
+class PushError(Exception):
+    """A bulk push that can't be read"""
+
+    def __init__(self, message, status_code=400):
+        Exception.__init__(self, message)
+        self.message = message
+        self.status_code = status_code
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def apply_updates(flask_redis, machines, batch_size=500):
+    """
+    Applies a push of machine states, writing only what actually changed.
+
+    `machines` is an iterable of (hostname, {field: value}) for the FIELDS
+    above, consumed `batch_size` machines at a time: each batch's current
+    state is read from the machine store in one round trip, diffed against
+    the push, and only changed fields are written, in one pipeline. So a push
+    of any size only holds a batch in memory.
+
+    Once every batch is written, rooms with a visible change get their
+    snapshot rebuilt, their version bumped and an update published, and every
+    room in the push is sampled for the occupancy history. This also happens
+    if reading `machines` fails part way, so whatever was written shows up.
+
+    Returns a summary of the changes.
+    """
+    from map import history, machine_store, occupants, room_counts, versions
+
+    # no transaction: a push spans sites, and so Redis Cluster slots
+    pipe = flask_redis.pipeline(transaction=False)
+    count = 0
+    changed_machines = 0
+    changed_fields = 0
+    rooms = set()
+    placed = set()
+    cascader_hashes = None
+
+    try:
+        for batch in batches(machines, batch_size):
+            count += len(batch)
+
+            # a host pushed twice in one batch would be diffed twice against
+            # the same stored state, so only its last record counts
+            batch = list(OrderedDict(batch).items())
+
+            # or it may be in two batches, so write the last one before reading
+            if len(pipe):
+                pipe.execute()
+
+            previous = machine_store.lookup([host for host, _ in batch])
+
+            for (host, state), (site, room, old) in zip(batch, previous):
+                if room:
+                    placed.add((site, room))
+
+                changes = {field: value for field, value in state.items() if old.get(field) != value}
+                if not changes:
+                    continue
+
+                machine_store.write(pipe, host, site, room, old, changes)
+                changed_machines += 1
+                changed_fields += len(changes)
+
+                if 'user' in changes:
+                    occupants.move(pipe, host, room, old.get('user'), changes['user'])
+
+                    if cascader_hashes is None:
+                        cascader_hashes = room_counts.cascader_hashes()
+                    room_counts.move_user(pipe, cascader_hashes, room, old.get('user'), room, changes['user'])
+
+                if room and any(field in changes for field in VISIBLE_FIELDS):
+                    rooms.add((site, room))
+    finally:
+        room_keys = sorted(room for _, room in rooms)
+
+        now = time.time()
+        if rooms:
+            versions.bump_rooms(pipe, room_keys)
+            pipe.set("last-update", now)
+            for room in room_keys:
+                pipe.hset("room-updates", room, now)
+        pipe.execute()
+
+        if rooms:
+            write_snapshots(flask_redis, room_keys)
+
+            pipe = flask_redis.pipeline(transaction=False)
+            publish_room_updates(pipe, room_keys, now)
+            pipe.execute()
+
+    # sample every room in the push, changed or not, so quiet rooms count too
+    due = history.due(placed, now) if placed else []
+    if due:
+        history.record(room_counts.machines(due), now)
+
+    return {
+        "machines": count,
+        "changed_machines": changed_machines,
+        "changed_fields": changed_fields,
+        "changed_rooms": room_keys,
+    }
+
+
+def decompressed(stream, encoding):
+    """Returns a file-like reader of stream decoded from its Content-Encoding"""
+    if encoding in ("", "identity"):
+        return stream
+    if encoding in ("gzip", "x-gzip"):
+        return gzip.GzipFile(fileobj=stream, mode="rb")
+    if encoding == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise PushError("zstd pushes need the zstandard package", 415)
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+    raise PushError("Unsupported Content-Encoding: %s" % encoding, 415)
+
+
+def chunks(reader):
+    total = 0
+    while True:
+        try:
+            chunk = reader.read(CHUNK_SIZE)
+        except Exception:
+            raise PushError("Push could not be decompressed")
+        if not chunk:
+            return
+
+        total += len(chunk)
+        if total > MAX_PUSH_BYTES:
+            raise PushError("Push is larger than %d bytes" % MAX_PUSH_BYTES, 413)
+        yield chunk
+
+
+def ndjson_records(data):
+    pending = b""
+    for chunk in data:
+        *lines, pending = (pending + chunk).split(b"\n")
+        if len(pending) > MAX_RECORD_BYTES:
+            raise PushError("Record is longer than %d bytes" % MAX_RECORD_BYTES)
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    if pending.strip():
+        yield json.loads(pending)
+
+
+def msgpack_records(data):
+    try:
+        import msgpack
+    except ImportError:
+        raise PushError("msgpack pushes need the msgpack package", 415)
+
+    unpacker = msgpack.Unpacker(raw=False, max_buffer_size=CHUNK_SIZE + MAX_RECORD_BYTES)
+    fed = 0
+    for chunk in data:
+        unpacker.feed(chunk)
+        fed += len(chunk)
+        yield from unpacker
+    if unpacker.tell() != fed:
+        raise PushError("Push ends part way through a record")
+
+
+RECORD_FORMATS = {
+    "application/x-ndjson": ndjson_records,
+    "application/x-msgpack": msgpack_records,
+    "application/msgpack": msgpack_records,
+}
+
+
+def machine(record):
+    """
+    Returns (hostname, state) for one record of a bulk push: either an object
+    with the same keys as /api/update's machines, or an array of hostname
+    followed by the FIELDS.
+    """
+    if isinstance(record, dict):
+        host, values = record['hostname'], [record[field] for field in FIELDS]
+    else:
+        host, *values = record
+        if len(values) != len(FIELDS):
+            raise ValueError(record)
+    return str(host), {field: "" if value is None else str(value) for field, value in zip(FIELDS, values)}
+
+
+def read_push(stream, encoding, mimetype):
+    """
+    Stream-parses a bulk push, yielding (hostname, state) for each machine.
+
+    The body is one record per machine, either as newline-delimited JSON
+    (application/x-ndjson) or back to back msgpack values
+    (application/x-msgpack), optionally compressed with gzip or zstd. It is
+    decompressed and parsed CHUNK_SIZE bytes at a time, so the whole
+    document is never held in memory.
+    """
+    try:
+        parse = RECORD_FORMATS[mimetype]
+    except KeyError:
+        raise PushError("Unsupported Content-Type: %s" % mimetype, 415)
+
+    records = parse(chunks(decompressed(stream, encoding)))
+    while True:
+        try:
+            record = next(records)
+        except StopIteration:
+            return
+        except PushError:
+            raise
+        except Exception:
+            raise PushError("Malformed push content")
+
+        try:
+            yield machine(record)
+        except Exception:
+            raise PushError("Malformed machine record: %.100r" % (record,))
+
+
+def claim_key(worker, sequence):
+    return "ingest.{%s}.push.%d" % (worker, sequence)
+
+
+def sequence_key(worker):
+    return "ingest.{%s}.sequence" % worker
+
+
+def begin_push(flask_redis, worker, sequence):
+    """
+    Claims push `sequence` from `worker` before applying it, so a retry is
+    only applied once. Returns "ok" to go ahead, "duplicate" if this or a
+    later push from the worker has already been applied, or "in-progress"
+    if the same push is being applied by another request right now.
+    """
+    pipe = flask_redis.pipeline(transaction=False)
+    pipe.get(sequence_key(worker))
+    pipe.set(claim_key(worker, sequence), 1, nx=True, ex=CLAIM_TTL)
+    last, claimed = pipe.execute()
+
+    if last is not None and int(last) >= sequence:
+        if claimed:
+            flask_redis.delete(claim_key(worker, sequence))
+        return "duplicate"
+    return "ok" if claimed else "in-progress"
+
+
+def end_push(flask_redis, worker, sequence, applied):
+    """Releases the claim on a push, recording it as applied if it was"""
+    def record(pipe):
+        last = pipe.get(sequence_key(worker))
+        pipe.multi()
+        if applied and (last is None or int(last) < sequence):
+            pipe.set(sequence_key(worker), sequence, ex=SEQUENCE_TTL)
+        pipe.delete(claim_key(worker, sequence))
+
+    # both keys are in the worker's slot
+    flask_redis.transaction(record, sequence_key(worker))
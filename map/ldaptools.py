@@ -1,37 +1,67 @@
+from contextlib import contextmanager, nullcontext
+
 import ldap
 from ldap.filter import filter_format
 
+from .metrics import ldap_seconds, timed
+
 class LDAPTools():
-    def __init__(self, cm):
+    def __init__(self, cm, names=None, limiter=None):
         self.config = {
             "memberdn": "ou=People,dc=inf,dc=ed,dc=ac,dc=uk"
         }
 
         self.cm = cm
 
+        # optional NameCache in front of the name lookups
+        self.names = names
+
+        # optional Limiter bounding concurrent LDAP connections
+        self.limiter = limiter
+
+    @contextmanager
     def conn(self):
-        return self.cm.connection()
+        with self.limiter or nullcontext(), self.cm.connection() as l:
+            yield l
 
     def get_name(self, uun):
-        with self.conn() as l:
-            return self.get_name_bare(uun, l)
+        return self.get_names([uun]).get(uun)
 
     def get_names(self, uuns):
-        with self.conn() as l:
-            return self.get_names_bare(uuns, l)
+        """Takes a list of uuns and returns a dict of uun->name, only connecting to LDAP on a cache miss"""
+        names, missing = self.cached_names(uuns)
+        if missing:
+            with self.conn() as l:
+                names.update(self.fetch_names(missing, l))
+        return names
 
     def get_name_bare(self, uun, l):
-        ldap_filter = filter_format("uid=%s", [uun])
-        data = l.search_s(self.config['memberdn'], ldap.SCOPE_SUBTREE, ldap_filter, None)
-
-        if data:
-            dn, attrs = data[0]
-            return attrs['gecos'][0].decode('utf-8')
+        return self.get_names_bare([uun], l).get(uun)
 
     def get_names_bare(self, uuns, l):
         """Takes a list of uuns and returns a dict of uun->name"""
+        names, missing = self.cached_names(uuns)
+        if missing:
+            names.update(self.fetch_names(missing, l))
+        return names
+
+    def cached_names(self, uuns):
+        """Returns (names, missing) for uuns, without touching LDAP"""
+        if self.names is None:
+            return {}, list(set(uuns))
+        return self.names.get_many(uuns)
+
+    def fetch_names(self, uuns, l):
+        """Looks up uuns in one LDAP query, caching the result"""
+        names = self.query_names(uuns, l)
+        if self.names is not None:
+            self.names.put_many(uuns, names)
+        return names
+
+    def query_names(self, uuns, l):
         query = filter_format("(|" + ("(uid=%s)" * len(uuns)) + ")", uuns)
-        data = l.search_s(self.config["memberdn"], ldap.SCOPE_SUBTREE, query, ["gecos", "uid"])
+        with timed(ldap_seconds, query="names"):
+            data = l.search_s(self.config["memberdn"], ldap.SCOPE_SUBTREE, query, ["gecos", "uid"])
 
         names = {}
         for _, row in data:
@@ -45,12 +75,21 @@ class LDAPTools():
 
     def search_name_bare(self, name, l):
         ldap_filter = filter_format("(|(name=*%s*)(uid=%s))", [name, name])
-        data = l.search_s(self.config['memberdn'], ldap.SCOPE_SUBTREE, ldap_filter, ["gecos", "uid"])
+        with timed(ldap_seconds, query="search"):
+            data = l.search_s(self.config['memberdn'], ldap.SCOPE_SUBTREE, ldap_filter, ["gecos", "uid"])
 
         return map(lambda p: {
             'uun': p[1]['uid'][0].decode('utf-8'),
             'name': p[1]['gecos'][0].decode('utf-8'),
         }, data)
 
+    def list_people(self):
+        """Returns a list of (uun, name) for everyone in the People OU"""
+        with self.conn() as l, timed(ldap_seconds, query="list"):
+            data = l.search_s(self.config['memberdn'], ldap.SCOPE_SUBTREE, "(uid=*)", ["gecos", "uid"])
 
-
+        return [
+            (attrs['uid'][0].decode('utf-8'), attrs['gecos'][0].decode('utf-8'))
+            for _, attrs in data
+            if 'uid' in attrs and 'gecos' in attrs
+        ]
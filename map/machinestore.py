@@ -0,0 +1,138 @@
+from .ingest import FIELDS
+from .schema import tag
+
+
+class HashStore():
+    """
+    Machine state as one redis hash per machine, keyed by hostname.
+
+    This is the original format: simple to inspect, but every machine costs
+    a key, and its `room` and `site` are repeated in each hash. Keys are not
+    tagged by site, so on Redis Cluster use the compact store instead.
+    """
+
+    name = "hash"
+
+    def __init__(self, flask_redis, schema):
+        self.flask_redis = flask_redis
+        self.schema = schema
+
+    def read(self, machines):
+        """Returns the state of each (hostname, site, room key), in one round trip"""
+        pipe = self.flask_redis.pipeline(transaction=False)
+        for host, _, _ in machines:
+            pipe.hmget(host, *FIELDS)
+        return [
+            {field: value for field, value in zip(FIELDS, values) if value is not None}
+            for values in pipe.execute()
+        ]
+
+    def lookup(self, hosts):
+        """Returns (site, room key, state) for each hostname, as /api/update needs"""
+        pipe = self.flask_redis.pipeline(transaction=False)
+        for host in hosts:
+            pipe.hmget(host, "site", "room", *FIELDS)
+        return [
+            (site, room, {field: value for field, value in zip(FIELDS, values) if value is not None})
+            for site, room, *values in pipe.execute()
+        ]
+
+    def write(self, pipe, host, site, room_key, state, changes):
+        """Queues `changes` to a machine whose current state is `state`"""
+        pipe.hmset(host, changes)
+
+    def place(self, pipe, host, site, room_key, old_site, old_room_key, state):
+        """Queues a machine's move (or first placement) into a room, keeping `state`"""
+        pipe.hmset(host, dict(state, site=site, room=room_key))
+
+    def remove(self, pipe, host, site, room_key):
+        pipe.delete(host)
+
+
+class CompactStore():
+    """
+    Machine state packed into one redis hash per room.
+
+    `machines.{<site>}.<room>` maps each hostname to "status|timestamp|user",
+    so a room is a single small hash (which redis stores as a compact
+    ziplist) on its site's cluster slot, reading a room is one HGETALL, and
+    where a machine is comes from the schema rather than being stored with it.
+    """
+
+    name = "compact"
+    prefix = "machines."
+
+    def __init__(self, flask_redis, schema):
+        self.flask_redis = flask_redis
+        self.schema = schema
+
+    def key(self, site, room_key):
+        return "%s%s.%s" % (self.prefix, tag(site), room_key)
+
+    @staticmethod
+    def pack(state):
+        return "|".join([state.get('status', ''), state.get('timestamp', ''), state.get('user', '')])
+
+    @staticmethod
+    def unpack(packed):
+        if packed is None:
+            return {}
+        status, timestamp, user = packed.split("|", 2)
+        return {'status': status, 'timestamp': timestamp, 'user': user}
+
+    def read(self, machines):
+        pipe = self.flask_redis.pipeline(transaction=False)
+        rooms = sorted({(site, room_key) for _, site, room_key in machines if room_key})
+        for site, room_key in rooms:
+            pipe.hgetall(self.key(site, room_key))
+        packed = dict(zip(rooms, pipe.execute()))
+
+        return [
+            self.unpack(packed[site, room_key].get(host)) if room_key else {}
+            for host, site, room_key in machines
+        ]
+
+    def lookup(self, hosts):
+        # machines that aren't in any room have nowhere to be stored
+        placed = self.schema.hosts()
+        places = [placed.get(host, (None, None)) for host in hosts]
+        states = self.read([(host, site, room_key) for host, (site, room_key) in zip(hosts, places)])
+        return [(site, room_key, state) for (site, room_key), state in zip(places, states)]
+
+    def write(self, pipe, host, site, room_key, state, changes):
+        if room_key:
+            pipe.hset(self.key(site, room_key), host, self.pack(dict(state, **changes)))
+
+    def place(self, pipe, host, site, room_key, old_site, old_room_key, state):
+        if old_room_key:
+            pipe.hdel(self.key(old_site, old_room_key), host)
+        if state:
+            pipe.hset(self.key(site, room_key), host, self.pack(state))
+
+    def remove(self, pipe, host, site, room_key):
+        pipe.hdel(self.key(site, room_key), host)
+
+
+STORES = {store.name: store for store in (HashStore, CompactStore)}
+
+
+def migrate(flask_redis, schema, source, target):
+    """
+    Copies the state of every machine in the schema from one store to the
+    other, removing it from the source. Returns the number of machines.
+    """
+    machines = [
+        (m['hostname'], site, room_key)
+        for site in schema.sites()
+        for room_key, entry in schema.layout(site).items()
+        for m in entry['machines']
+    ]
+    states = source.read(machines)
+
+    pipe = flask_redis.pipeline()
+    for (host, site, room_key), state in zip(machines, states):
+        source.remove(pipe, host, site, room_key)
+        target.place(pipe, host, site, room_key, None, None, state)
+    pipe.execute()
+
+    return len(machines)
@@ -0,0 +1,116 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import has_request_context, request
+from prometheus_client import CollectorRegistry, CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+# Each gunicorn worker has its own copy of every metric. With
+# prometheus_multiproc_dir set, they are written to files in that directory
+# and /metrics adds them up across workers (see gunicorn.conf.py).
+MULTIPROCESS = "prometheus_multiproc_dir" in os.environ
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+request_seconds = Histogram(
+    "mapp_request_seconds", "Time spent handling a request",
+    ["endpoint", "method", "status"], buckets=LATENCY_BUCKETS)
+response_bytes = Histogram(
+    "mapp_response_bytes", "Size of response bodies",
+    ["endpoint"], buckets=SIZE_BUCKETS)
+request_bytes = Histogram(
+    "mapp_request_bytes", "Size of request bodies",
+    ["endpoint"], buckets=SIZE_BUCKETS)
+
+redis_roundtrips = Counter(
+    "mapp_redis_roundtrips_total", "Round trips to redis (a pipeline is one)", ["endpoint"])
+redis_commands = Counter(
+    "mapp_redis_commands_total", "Commands sent to redis", ["endpoint"])
+redis_seconds = Counter(
+    "mapp_redis_seconds_total", "Time spent waiting on redis", ["endpoint"])
+
+ldap_seconds = Histogram(
+    "mapp_ldap_query_seconds", "Time taken by LDAP queries",
+    ["endpoint", "query"], buckets=LATENCY_BUCKETS)
+
+cosign_seconds = Histogram(
+    "mapp_cosign_check_seconds", "Time taken by CoSign check service calls",
+    ["endpoint"], buckets=LATENCY_BUCKETS)
+cosign_cache = Counter(
+    "mapp_cosign_cache_total", "CoSign cookie validations by cache result", ["endpoint", "result"])
+
+# Limiters (see concurrency.py): in flight is summed across live workers;
+# the limit and peak are per worker, so the highest since startup is reported
+limiter_limit = Gauge(
+    "mapp_limiter_limit", "Calls to a dependency each worker allows in flight at once",
+    ["limiter"], multiprocess_mode="max")
+limiter_in_flight = Gauge(
+    "mapp_limiter_in_flight", "Calls to a dependency in flight",
+    ["limiter"], multiprocess_mode="livesum")
+limiter_peak = Gauge(
+    "mapp_limiter_peak_in_flight", "Most calls to a dependency a worker has had in flight at once",
+    ["limiter"], multiprocess_mode="max")
+limiter_wait_seconds = Histogram(
+    "mapp_limiter_wait_seconds", "Time calls to a dependency waited for a free slot",
+    ["limiter"], buckets=LATENCY_BUCKETS)
+
+_local = threading.local()
+
+
+def current_endpoint():
+    """The endpoint that work is being done for, also inside background jobs"""
+    if has_request_context():
+        return request.endpoint or "none"
+    return getattr(_local, "endpoint", "none")
+
+
+@contextmanager
+def endpoint(name):
+    """Attributes dependency calls made in this thread to `name`"""
+    previous = getattr(_local, "endpoint", None)
+    _local.endpoint = name
+    try:
+        yield
+    finally:
+        _local.endpoint = previous
+
+
+@contextmanager
+def timed(histogram, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(endpoint=current_endpoint(), **labels).observe(time.perf_counter() - start)
+
+
+def observe_request(response, seconds, roundtrips, commands, redis_time):
+    endpoint = request.endpoint or "none"
+
+    request_seconds.labels(endpoint, request.method, response.status_code).observe(seconds)
+
+    if request.content_length:
+        request_bytes.labels(endpoint).observe(request.content_length)
+
+    # streamed responses (e.g. /api/events) have no length
+    size = response.calculate_content_length()
+    if size is not None:
+        response_bytes.labels(endpoint).observe(size)
+
+    if roundtrips:
+        redis_roundtrips.labels(endpoint).inc(roundtrips)
+        redis_commands.labels(endpoint).inc(commands)
+        redis_seconds.labels(endpoint).inc(redis_time)
+
+
+def export():
+    """Returns (body, content type) for a scrape of every worker's metrics"""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        from prometheus_client import REGISTRY as registry
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,94 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class NameCache():
+    """
+    Two-tier cache of uun -> display name.
+
+    Names are held in a small per-process LRU in front of redis, where each
+    name lives under `ldap.name.<uun>` with a TTL so every worker shares it.
+    Uuns LDAP doesn't know are cached too (as an empty string) for a shorter
+    time, so unknown users don't cause a query on every refresh.
+    """
+
+    prefix = "ldap.name."
+
+    def __init__(self, flask_redis, ttl=24*60*60, negative_ttl=60*60, local_size=4096, local_ttl=5*60):
+        self.flask_redis = flask_redis
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.local_size = local_size
+        self.local_ttl = local_ttl
+
+        self.local = OrderedDict()
+        self.lock = Lock()
+
+    def _get_local(self, uun, now):
+        entry = self.local.get(uun)
+        if entry is None:
+            return None
+
+        expires, name = entry
+        if expires < now:
+            del self.local[uun]
+            return None
+
+        self.local.move_to_end(uun)
+        return name
+
+    def _put_local(self, uun, name, now):
+        self.local[uun] = (now + self.local_ttl, name)
+        self.local.move_to_end(uun)
+        while len(self.local) > self.local_size:
+            self.local.popitem(last=False)
+
+    def get_many(self, uuns):
+        """
+        Looks up uuns in the cache.
+
+        Returns (names, missing): a dict of uun -> name for every cached uun
+        LDAP knows about, and a list of uuns that are not cached at all.
+        """
+        now = time.time()
+        names = {}
+        remote = []
+
+        with self.lock:
+            for uun in set(uuns):
+                name = self._get_local(uun, now)
+                if name is None:
+                    remote.append(uun)
+                elif name:
+                    names[uun] = name
+
+        if not remote:
+            return names, []
+
+        missing = []
+        values = self.flask_redis.mget([self.prefix + uun for uun in remote])
+        with self.lock:
+            for uun, name in zip(remote, values):
+                if name is None:
+                    missing.append(uun)
+                    continue
+
+                self._put_local(uun, name, now)
+                if name:
+                    names[uun] = name
+
+        return names, missing
+
+    def put_many(self, uuns, names):
+        """Caches the result of looking up `uuns`, given the uun -> name dict LDAP returned"""
+        now = time.time()
+        pipe = self.flask_redis.pipeline(transaction=False)
+
+        with self.lock:
+            for uun in uuns:
+                name = names.get(uun, "")
+                pipe.setex(self.prefix + uun, self.ttl if name else self.negative_ttl, name)
+                self._put_local(uun, name, now)
+
+        pipe.execute()
@@ -0,0 +1,49 @@
+class OccupantIndex():
+    """
+    Index of where each user is sitting.
+
+    For every uun hash currently logged in somewhere, `occupant.<hash>` is a
+    redis hash of hostname -> room key. It is kept up to date by /api/update
+    as users log in and out, and by schema loads as machines move or go away, so finding a
+    set of users costs one HGETALL each instead of a scan of the whole site.
+    """
+
+    prefix = "occupant."
+
+    def __init__(self, flask_redis):
+        self.flask_redis = flask_redis
+
+    def key(self, uun_hash):
+        return self.prefix + uun_hash
+
+    def move(self, pipe, host, room, old_user, new_user):
+        """Queues the index changes for `host` changing from old_user to new_user"""
+        if old_user:
+            pipe.hdel(self.key(old_user), host)
+        if new_user and room:
+            pipe.hset(self.key(new_user), host, room)
+
+    def locate(self, hashes):
+        """Returns a dict of uun hash -> {hostname: room key} for the given hashes"""
+        hashes = list(hashes)
+
+        pipe = self.flask_redis.pipeline(transaction=False)
+        for uun_hash in hashes:
+            pipe.hgetall(self.key(uun_hash))
+
+        return dict(zip(hashes, pipe.execute()))
+
+    def rebuild(self, sites):
+        """Rebuilds the whole index from the machines of the given sites"""
+        pipe = self.flask_redis.pipeline()
+        for key in self.flask_redis.scan_iter(match=self.prefix + "*"):
+            pipe.delete(key)
+
+        count = 0
+        for site in sites:
+            for room, machine in site.occupied():
+                pipe.hset(self.key(machine['user']), machine['hostname'], room['key'])
+                count += 1
+
+        pipe.execute()
+        return count
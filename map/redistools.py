@@ -0,0 +1,53 @@
+import time
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+from redis import StrictRedis
+from redis.client import Pipeline
+
+
+@contextmanager
+def count_roundtrip(commands=1):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if has_app_context():
+            g.redis_roundtrips = g.get("redis_roundtrips", 0) + 1
+            g.redis_commands = g.get("redis_commands", 0) + commands
+            g.redis_seconds = g.get("redis_seconds", 0) + time.perf_counter() - start
+
+
+class CountingPipeline(Pipeline):
+    """A pipeline that counts each flush to the server as one round trip"""
+
+    def immediate_execute_command(self, *args, **options):
+        with count_roundtrip():
+            return super().immediate_execute_command(*args, **options)
+
+    def execute(self, raise_on_error=True):
+        if not self.command_stack:
+            return super().execute(raise_on_error)
+        with count_roundtrip(len(self.command_stack)):
+            return super().execute(raise_on_error)
+
+
+class CountingRedis(StrictRedis):
+    """
+    StrictRedis that counts the round trips made while handling a request.
+
+    The running totals are kept in `g.redis_roundtrips`, `g.redis_commands`
+    (counting every command in a pipeline separately) and `g.redis_seconds`
+    (time spent waiting on redis).
+    """
+
+    def execute_command(self, *args, **options):
+        with count_roundtrip():
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return CountingPipeline(
+            self.connection_pool,
+            self.response_callbacks,
+            transaction,
+            shard_hint)
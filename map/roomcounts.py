@@ -0,0 +1,126 @@
+from collections import Counter
+
+MACHINE_STATS = ("free", "used", "offline")
+STATS = MACHINE_STATS + ("cascaders",)
+
+
+def machine_counts(snapshot):
+    """(free, used, offline) of a room's snapshot"""
+    free, offline = snapshot['num_free'], snapshot['num_offline']
+    return free, snapshot['num_machines'] - free - offline, offline
+
+
+class RoomCounts():
+    """
+    Per-room summary numbers, kept up to date as state changes.
+
+    Every room's counts are fields of the single `room-counts` redis hash,
+    named `<room>.<stat>`, so all of them are read together in one call:
+    - `free`, `used` and `offline` machines are set from a room's snapshot
+      whenever it is rebuilt, which /api/update and schema loads do for
+      every room they change;
+    - `cascaders` is the number of the room's machines a cascader is logged
+      in to. It moves by one as cascaders log in and out (/api/update),
+      start or stop cascading (User.cascade), and as machines move between
+      rooms (schema loads).
+    """
+
+    key = "room-counts"
+
+    def __init__(self, flask_redis):
+        self.flask_redis = flask_redis
+
+    def set_machines(self, pipe, snapshot):
+        """Queues a room's machine counts, from its snapshot"""
+        pipe.hmset(self.key, {
+            snapshot['room']['key'] + "." + stat: value
+            for stat, value in zip(MACHINE_STATS, machine_counts(snapshot))
+        })
+
+    def add_cascaders(self, pipe, room_key, amount):
+        if room_key and amount:
+            pipe.hincrby(self.key, room_key + ".cascaders", amount)
+
+    def move_user(self, pipe, cascader_hashes, old_room, old_user, new_room, new_user):
+        """Queues the change to cascader counts of a machine's user or room changing"""
+        if old_user in cascader_hashes:
+            self.add_cascaders(pipe, old_room, -1)
+        if new_user in cascader_hashes:
+            self.add_cascaders(pipe, new_room, 1)
+
+    def drop(self, pipe, room_key):
+        pipe.hdel(self.key, *[room_key + "." + stat for stat in STATS])
+
+    def cascader_hashes(self):
+        """The uun hash of everyone cascading, for move_user"""
+        from map import uun_hashes
+        return {uun_hashes.hash(uun) for uun in self.flask_redis.smembers("cascaders.users")}
+
+    def all(self):
+        """Returns {room key: {stat: count}} for every room"""
+        fields = self.flask_redis.hgetall(self.key)
+        if not fields:
+            self.rebuild()
+            fields = self.flask_redis.hgetall(self.key)
+
+        counts = {}
+        for field, value in fields.items():
+            room_key, stat = field.rsplit(".", 1)
+            counts.setdefault(room_key, dict.fromkeys(STATS, 0))[stat] = int(value)
+        return counts
+
+    def machines(self, rooms):
+        """
+        Returns {(site, room key): (free, used, offline)} for the given
+        (site, room key)s that exist. Rooms without counts yet are counted
+        from their snapshots.
+        """
+        from .snapshot import load_snapshots
+
+        rooms = list(rooms)
+
+        pipe = self.flask_redis.pipeline(transaction=False)
+        for _, room_key in rooms:
+            pipe.hmget(self.key, *[room_key + "." + stat for stat in MACHINE_STATS])
+
+        counts = {}
+        missing = []
+        for room, values in zip(rooms, pipe.execute()):
+            if None in values:
+                missing.append(room)
+            else:
+                counts[room] = tuple(int(value) for value in values)
+
+        if missing:
+            snapshots, _ = load_snapshots(self.flask_redis, [room_key for _, room_key in missing])
+            pipe = self.flask_redis.pipeline(transaction=False)
+            for site, room_key in missing:
+                if room_key in snapshots:
+                    self.set_machines(pipe, snapshots[room_key])
+                    counts[site, room_key] = machine_counts(snapshots[room_key])
+            pipe.execute()
+
+        return counts
+
+    def rebuild(self):
+        """
+        Recounts every room from its snapshot and the occupant index, e.g.
+        after upgrading. Returns the number of rooms.
+        """
+        from map import occupants, schema
+        from .snapshot import load_snapshots
+
+        room_keys = [room_key for site in schema.sites() for room_key in schema.layout(site)]
+        snapshots, _ = load_snapshots(self.flask_redis, room_keys)
+
+        located = occupants.locate(self.cascader_hashes())
+        cascaders = Counter(room_key for hosts in located.values() for room_key in hosts.values())
+
+        pipe = self.flask_redis.pipeline()
+        pipe.delete(self.key)
+        for room_key, snapshot in snapshots.items():
+            self.set_machines(pipe, snapshot)
+            pipe.hset(self.key, room_key + ".cascaders", cascaders[room_key])
+        pipe.execute()
+
+        return len(snapshots)
@@ -0,0 +1,410 @@
+import json
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock
+
+
+class SchemaError(Exception):
+    pass
+
+
+def tag(site):
+    """
+    Redis Cluster hash tag for a site: keys containing it all hash to the
+    same slot, so everything about one site can be read in one pipeline (or
+    changed in one transaction) on one node.
+    """
+    return "{%s}" % site
+
+
+class Schema():
+    """
+    Generation-swapped layouts of each site's rooms and machines.
+
+    A site's layout is one immutable JSON blob, `schema.{<site>}.<generation>`:
+
+        {room key: {"room": {"site", "key", "name"},
+                    "machines": [{"hostname", "row", "col"}, ...]}}
+
+    and `schema.{<site>}` points at the live generation. A schema load
+    writes a new generation for each site it touches and validates it
+    against every other site. Each site then goes live by flipping its
+    pointer in one transaction, which also moves that site's machine state.
+    Readers therefore see either the old layout or the new one, never a
+    half-built room. Old generations are left to expire.
+
+    Everything a transaction touches is tagged with the site (see `tag`), so
+    it works on a single Redis Cluster slot. The cross-site indexes,
+    `mapp.sites` and `schema.rooms` (room key -> site), are updated right
+    after the flips; schema loads are serialised by `schema.lock`.
+
+    Machine state is kept apart from the layout, by the configured machine
+    store (see machinestore.py).
+
+    Layouts never change once written, so they are cached per process by
+    generation, and loading a site costs a single GET of its pointer.
+    """
+
+    prefix = "schema."
+    sites_key = "mapp.sites"
+    rooms_key = "schema.rooms"
+    counter_key = "schema.generations"
+    lock_key = "schema.lock"
+
+    # a staged generation that is never made live expires after this
+    staging_ttl = 60*60
+    # how long a replaced generation is kept for readers that are mid-request
+    grace_ttl = 5*60
+    # how long the room -> site index is trusted for before being re-read
+    rooms_ttl = 10
+    # how long a schema load may hold the lock, and how long to wait for it
+    lock_ttl = 60
+    lock_wait = 30
+
+    def __init__(self, flask_redis, local_size=32):
+        self.flask_redis = flask_redis
+        self.local_size = local_size
+
+        self.local = OrderedDict()
+        self.lock = Lock()
+
+        # (generations, hostname index) for the last set of live generations
+        self._hosts = None
+        # (expiry, room key -> site)
+        self._room_sites = None
+
+    def pointer_key(self, site):
+        return self.prefix + tag(site)
+
+    def layout_key(self, site, generation):
+        return "%s%s.%s" % (self.prefix, tag(site), generation)
+
+    def sites(self):
+        return sorted(self.flask_redis.smembers(self.sites_key))
+
+    def generation(self, site):
+        return self.flask_redis.get(self.pointer_key(site))
+
+    def generations(self, sites):
+        """Returns the live generation of each site, in one round trip"""
+        pipe = self.flask_redis.pipeline(transaction=False)
+        for site in sites:
+            pipe.get(self.pointer_key(site))
+        return dict(zip(sites, pipe.execute()))
+
+    def layout(self, site, generation=None):
+        """Returns the rooms of a site (at `generation`, or the live one)"""
+        if generation is None:
+            generation = self.generation(site)
+        if generation is None:
+            return {}
+
+        key = (site, generation)
+        with self.lock:
+            if key in self.local:
+                self.local.move_to_end(key)
+                return self.local[key]
+
+        blob = self.flask_redis.get(self.layout_key(site, generation))
+        if blob is None:
+            # superseded and expired while we were looking
+            latest = self.generation(site)
+            if latest is None or latest == generation:
+                return {}
+            return self.layout(site, latest)
+        rooms = json.loads(blob)
+
+        with self.lock:
+            self.local[key] = rooms
+            while len(self.local) > self.local_size:
+                self.local.popitem(last=False)
+
+        return rooms
+
+    def layouts(self, sites=None):
+        """Returns {site: rooms} for the given sites (by default, all of them)"""
+        if sites is None:
+            sites = self.sites()
+        return {
+            site: self.layout(site, generation)
+            for site, generation in self.generations(sites).items()
+        }
+
+    def hosts(self):
+        """Returns a dict of hostname -> (site, room key) across every live site"""
+        generations = tuple(sorted(self.generations(self.sites()).items()))
+
+        with self.lock:
+            if self._hosts is not None and self._hosts[0] == generations:
+                return self._hosts[1]
+
+        hosts = {}
+        for site, generation in generations:
+            for room_key, entry in self.layout(site, generation).items():
+                hosts.update((m['hostname'], (site, room_key)) for m in entry['machines'])
+
+        with self.lock:
+            self._hosts = (generations, hosts)
+        return hosts
+
+    def site_of(self, room_key, refresh=False):
+        """Returns the site a room is in, or None, from a briefly cached index"""
+        now = time.time()
+        with self.lock:
+            cached = self._room_sites
+        if refresh or cached is None or cached[0] < now or room_key not in cached[1]:
+            cached = (now + self.rooms_ttl, self.flask_redis.hgetall(self.rooms_key))
+            with self.lock:
+                self._room_sites = cached
+        return cached[1].get(room_key)
+
+    def warm(self):
+        """Loads every live layout, and the indexes built from them, into this process. Returns the layouts."""
+        layouts = self.layouts()
+        self.hosts()
+        self.site_of(None, refresh=True)
+        return layouts
+
+    def room(self, room_key):
+        """
+        Returns the layout of a single room.
+
+        Raises KeyError if the room does not exist.
+        """
+        site = self.site_of(room_key)
+        if site is None:
+            raise KeyError(room_key)
+
+        layout = self.layout(site)
+        if room_key not in layout:
+            # the room has moved to another site since the index was read
+            site = self.site_of(room_key, refresh=True)
+            if site is None:
+                raise KeyError(room_key)
+            layout = self.layout(site)
+        return layout[room_key]
+
+    def validate(self, layouts):
+        """Checks that no room or machine is listed twice across all sites"""
+        rooms = {}
+        hosts = {}
+        for site, layout in sorted(layouts.items()):
+            for room_key, entry in layout.items():
+                if entry['room']['site'] != site or entry['room']['key'] != room_key:
+                    raise SchemaError("Room %s is filed under the wrong site or key" % room_key)
+                if room_key in rooms:
+                    raise SchemaError("Room %s is in both %s and %s" % (room_key, rooms[room_key], site))
+                rooms[room_key] = site
+
+                for machine in entry['machines']:
+                    hostname = machine['hostname']
+                    if hostname in hosts:
+                        raise SchemaError("Machine %s is in both %s and %s" % (hostname, hosts[hostname], room_key))
+                    hosts[hostname] = room_key
+
+    def load(self, rooms, drop=(), reset=False):
+        """
+        Makes a new generation live for every site touched.
+
+        `rooms` is a list of room layouts to add or replace, `drop` a list of
+        room keys to remove, and `reset` replaces every site wholesale with
+        just `rooms`. Machines that stay in the same room keep their state.
+
+        Returns (site, room key) for each room that changed. Raises
+        SchemaError if the result would be invalid, in which case nothing is
+        changed.
+        """
+        token = str(uuid.uuid4())
+        deadline = time.time() + self.lock_wait
+        while not self.flask_redis.set(self.lock_key, token, nx=True, ex=self.lock_ttl):
+            if time.time() > deadline:
+                raise SchemaError("Another schema load is still running")
+            time.sleep(0.1)
+
+        try:
+            return self._load(rooms, drop, reset)
+        finally:
+            if self.flask_redis.get(self.lock_key) == token:
+                self.flask_redis.delete(self.lock_key)
+            with self.lock:
+                self._room_sites = None
+
+    def _load(self, rooms, drop, reset):
+        from map import machine_store, occupants, room_counts, versions
+        from .snapshot import snapshot_key
+
+        sites = set(self.sites()) | {entry['room']['site'] for entry in rooms}
+        room_sites = self.flask_redis.hgetall(self.rooms_key)
+        generations = self.generations(sorted(sites))
+        current = {site: self.layout(site, generation) for site, generation in generations.items()}
+
+        # work out every site's next layout
+        layouts = {site: ({} if reset else dict(layout)) for site, layout in current.items()}
+        for room_key in list(drop) + [entry['room']['key'] for entry in rooms]:
+            site = room_sites.get(room_key)
+            if site in layouts:
+                layouts[site].pop(room_key, None)
+        for entry in rooms:
+            layouts[entry['room']['site']][entry['room']['key']] = entry
+
+        self.validate(layouts)
+
+        touched = sorted(site for site in layouts if layouts[site] != current[site])
+
+        old_hosts = {}
+        new_hosts = {}
+        changed_rooms = set()
+        for site in touched:
+            old, new = current[site], layouts[site]
+            for room_key in set(old) | set(new):
+                if old.get(room_key) != new.get(room_key):
+                    changed_rooms.add((site, room_key))
+            for room_key, entry in old.items():
+                old_hosts.update((m['hostname'], (site, room_key)) for m in entry['machines'])
+            for room_key, entry in new.items():
+                new_hosts.update((m['hostname'], (site, room_key)) for m in entry['machines'])
+
+        removed = [host for host in old_hosts if host not in new_hosts]
+        moved = [host for host in new_hosts if old_hosts.get(host) != new_hosts[host]]
+
+        states = dict(zip(removed + moved, machine_store.read(
+            [(host,) + old_hosts.get(host, (None, None)) for host in removed + moved])))
+
+        for site in touched:
+            # stage the new generation; it stays invisible until the flip
+            staged = None
+            if layouts[site]:
+                staged = self.flask_redis.incr(self.counter_key)
+                self.flask_redis.set(self.layout_key(site, staged), json.dumps(layouts[site]), ex=self.staging_ttl)
+
+            # the flip: everything in here is tagged with the site
+            pipe = self.flask_redis.pipeline()
+            if generations[site] is not None:
+                pipe.expire(self.layout_key(site, generations[site]), self.grace_ttl)
+            if staged is not None:
+                pipe.persist(self.layout_key(site, staged))
+                pipe.set(self.pointer_key(site), staged)
+            else:
+                pipe.delete(self.pointer_key(site))
+
+            for host in removed:
+                if old_hosts[host][0] == site:
+                    machine_store.remove(pipe, host, *old_hosts[host])
+            for host in moved:
+                if new_hosts[host][0] == site:
+                    machine_store.place(pipe, host, *new_hosts[host], *old_hosts.get(host, (None, None)), states[host])
+
+            for changed_site, room_key in changed_rooms:
+                if changed_site == site:
+                    pipe.delete(snapshot_key(site, room_key))
+            pipe.execute()
+
+        # then the indexes that span sites
+        pipe = self.flask_redis.pipeline(transaction=False)
+        for site in touched:
+            for room_key in current[site]:
+                if room_key not in layouts[site]:
+                    pipe.hdel(self.rooms_key, room_key)
+                    room_counts.drop(pipe, room_key)
+            if layouts[site]:
+                pipe.sadd(self.sites_key, site)
+                pipe.hmset(self.rooms_key, {room_key: site for room_key in layouts[site]})
+            else:
+                pipe.srem(self.sites_key, site)
+
+        def kept(site, room_key):
+            # a dropped room's counts were deleted above, so must not be decremented
+            return room_key if site is not None and room_key in layouts[site] else None
+
+        cascader_hashes = room_counts.cascader_hashes()
+        for host in removed:
+            user = states[host].get('user')
+            occupants.move(pipe, host, None, user, None)
+            room_counts.move_user(pipe, cascader_hashes, kept(*old_hosts[host]), user, None, None)
+        for host in moved:
+            user = states[host].get('user')
+            if user:
+                occupants.move(pipe, host, new_hosts[host][1], user, user)
+                room_counts.move_user(pipe, cascader_hashes, kept(*old_hosts.get(host, (None, None))), user, new_hosts[host][1], user)
+
+        versions.bump_rooms(pipe, [room_key for _, room_key in changed_rooms])
+        pipe.execute()
+
+        return sorted(changed_rooms)
+
+    def migrate(self, site):
+        """
+        Converts a site stored an old way into a live generation, then
+        deletes the old keys. That is either per-room keys (`<site>-rooms`,
+        room hashes, `<room>-machines` lists and layout fields in machine
+        hashes), or a generation from before keys were tagged by site.
+
+        Returns the number of rooms migrated.
+        """
+        untagged = self.prefix + site
+        generation = self.flask_redis.get(untagged)
+        if generation is not None:
+            blob = self.flask_redis.get("%s.%s" % (untagged, generation))
+            rooms = list(json.loads(blob).values()) if blob else []
+            self.load(rooms)
+            self.flask_redis.delete(untagged, "%s.%s" % (untagged, generation))
+            return len(rooms)
+
+        room_keys = self.flask_redis.smembers(site + "-rooms")
+
+        pipe = self.flask_redis.pipeline(transaction=False)
+        for room_key in room_keys:
+            pipe.hgetall(room_key)
+            pipe.lrange(room_key + "-machines", 0, -1)
+        results = pipe.execute()
+
+        rooms = []
+        for room_key, room, hostnames in zip(room_keys, results[0::2], results[1::2]):
+            if not room:
+                continue
+
+            pipe = self.flask_redis.pipeline(transaction=False)
+            for hostname in hostnames:
+                pipe.hmget(hostname, "row", "col")
+            machines = [
+                {'hostname': hostname, 'row': int(row), 'col': int(col)}
+                for hostname, (row, col) in zip(hostnames, pipe.execute())
+                if row is not None and col is not None
+            ]
+            machines.sort(key=lambda m: (m['row'], m['col']))
+
+            rooms.append({
+                'room': {'site': site, 'key': room_key, 'name': room.get('name', room_key)},
+                'machines': machines,
+            })
+
+        self.load(rooms)
+
+        pipe = self.flask_redis.pipeline()
+        for entry in rooms:
+            for machine in entry['machines']:
+                pipe.hdel(machine['hostname'], "hostname", "row", "col")
+        for room_key in room_keys:
+            pipe.delete(room_key, room_key + "-machines")
+        pipe.delete(site + "-rooms")
+        pipe.execute()
+
+        return len(rooms)
+
+
+def machine_state(site, room_key, layout, state):
+    """Merges a machine's place in the layout with its reported state"""
+    machine = {
+        'hostname': layout['hostname'],
+        'row': str(layout['row']),
+        'col': str(layout['col']),
+        'site': site,
+        'room': room_key,
+        'user': '',
+        'timestamp': '',
+        'status': 'offline',
+    }
+    if state:
+        machine.update((field, state[field]) for field in ('user', 'timestamp', 'status') if field in state)
+    return machine
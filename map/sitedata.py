@@ -0,0 +1,85 @@
+from flask import g, has_app_context
+
+from .schema import machine_state
+
+
+class Site():
+    """
+    Bulk loader for a site's rooms and machines.
+
+    The layout comes from the site's live schema generation (one GET of its
+    pointer, the layout itself being cached per process) unless it is given,
+    and machine states are fetched from the machine store with a single
+    pipelined round trip. Machines are loaded lazily, so callers that only
+    need room names (like the nav bar) never pay for them.
+    """
+
+    def __init__(self, flask_redis, name, layout=None):
+        from map import machine_store, schema
+
+        self.flask_redis = flask_redis
+        self.schema = schema
+        self.machine_store = machine_store
+        self.name = name
+
+        self._layout = layout
+        self._rooms = None
+        self._machines = None
+
+    def _load_rooms(self):
+        if self._layout is None:
+            self._layout = self.schema.layout(self.name)
+        self._rooms = {room_key: self._layout[room_key]['room'] for room_key in sorted(self._layout)}
+
+    def _load_machines(self):
+        states = iter(self.machine_store.read([
+            (m['hostname'], self.name, room_key)
+            for room_key in self.rooms
+            for m in self._layout[room_key]['machines']
+        ]))
+
+        self._machines = {
+            room_key: [
+                machine_state(self.name, room_key, m, next(states))
+                for m in self._layout[room_key]['machines']
+            ]
+            for room_key in self.rooms
+        }
+
+    @property
+    def rooms(self):
+        """Dict of room key -> room hash, ordered by room key"""
+        if self._rooms is None:
+            self._load_rooms()
+        return self._rooms
+
+    def machines(self, room_key):
+        """List of machine hashes in a room"""
+        if self._machines is None:
+            self._load_machines()
+        return self._machines.get(room_key, [])
+
+    def occupied(self):
+        """Yields (room, machine) for every machine with someone logged in"""
+        for room_key, room in self.rooms.items():
+            for machine in self.machines(room_key):
+                if machine.get('user'):
+                    yield room, machine
+
+
+def get_sites():
+    """Returns every Site, ordered by name, fetching their layouts together"""
+    from map import flask_redis, schema
+
+    if has_app_context() and "all_sites" in g:
+        return g.all_sites
+
+    sites = [Site(flask_redis, name, layout) for name, layout in sorted(schema.layouts().items())]
+    if has_app_context():
+        g.all_sites = sites
+    return sites
+
+
+def all_rooms():
+    """Returns a dict of room key -> room hash across every site"""
+    return {room_key: room for site in get_sites() for room_key, room in site.rooms.items()}
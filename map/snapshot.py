@@ -0,0 +1,177 @@
+import json
+
+from .grid import build_grid
+from .schema import machine_state, tag
+from .wire import layout_id
+
+# Bump this whenever the shape of a snapshot changes, so that old blobs are
+# ignored (and rebuilt on demand) instead of being served to clients.
+SNAPSHOT_VERSION = 5
+
+
+def snapshot_key(site, room_key):
+    return "room-snapshot.v%d.%s.%s" % (SNAPSHOT_VERSION, tag(site), room_key)
+
+
+def build_snapshot(flask_redis, room_key, version=0):
+    """
+    Builds the user-independent view of a room: its grid, statuses, hashed
+    occupants and availability counts, and the id of its layout for the
+    compact refresh format. `version` is the room's version (see Versions),
+    read before the build, so the snapshot is at least that up to date.
+
+    Raises KeyError if the room does not exist.
+    """
+    from map import machine_store, schema
+
+    layout = schema.room(str(room_key))
+    room = layout['room']
+
+    states = machine_store.read([(m['hostname'], room['site'], room['key']) for m in layout['machines']])
+    machines = {
+        m['hostname']: machine_state(room['site'], room['key'], m, state)
+        for m, state in zip(layout['machines'], states)
+    }
+
+    rows = build_grid(machines.values())
+
+    num_machines = len(machines)
+    num_used = 0
+    num_offline = 0
+
+    for machine in machines.values():
+        try:
+            if machine['user'] != "" or machine['status'] == "offline":
+                num_used += 1
+            if machine['user'] == "" and machine['status'] == "offline":
+                num_offline += 1
+        except Exception:
+            pass
+
+        if machine.get('user') == "":
+            del machine['user']
+
+        # the worker's timestamp isn't shown, and leaving it out means pushes
+        # that only move timestamps don't make the snapshot stale
+        machine.pop('timestamp', None)
+
+    num_free = num_machines - num_used
+
+    return {
+        "room"             : room,
+        "rows"             : rows,
+        "layout_id"        : layout_id(rows),
+        "num_free"         : num_free,
+        "num_machines"     : num_machines,
+        "num_offline"      : num_offline,
+        "low_availability" : num_free <= 0.3 * num_machines,
+        "version"          : version,
+    }
+
+
+def store_snapshots(flask_redis, snapshots):
+    """
+    Stores snapshots, along with their rooms' machine counts, except where
+    one built from a later version of the room is already stored. So two
+    rebuilds of a room that race can't leave the older one in place.
+    Returns the snapshots that were stored.
+    """
+    from map import room_counts
+
+    by_site = {}
+    for snapshot in snapshots:
+        by_site.setdefault(snapshot['room']['site'], []).append(snapshot)
+
+    stored = []
+    for site, site_snapshots in sorted(by_site.items()):
+        keys = [snapshot_key(site, snapshot['room']['key']) for snapshot in site_snapshots]
+
+        def store(pipe):
+            current = pipe.mget(keys)
+            newer = [
+                (key, snapshot) for key, snapshot, blob in zip(keys, site_snapshots, current)
+                if blob is None or json.loads(blob).get('version', 0) <= snapshot['version']
+            ]
+            pipe.multi()
+            for key, snapshot in newer:
+                pipe.set(key, json.dumps(snapshot))
+            return [snapshot for _, snapshot in newer]
+
+        # a site's snapshots share its hash tag, so can be watched together
+        stored += flask_redis.transaction(store, *keys, value_from_callable=True)
+
+    if stored:
+        pipe = flask_redis.pipeline(transaction=False)
+        for snapshot in stored:
+            room_counts.set_machines(pipe, snapshot)
+        pipe.execute()
+
+    return stored
+
+
+def write_snapshots(flask_redis, room_keys):
+    """
+    Rebuilds and stores the snapshot of every given room. Schema loads
+    delete the snapshots of rooms that go away.
+    """
+    from map import versions
+
+    room_versions = versions.rooms(room_keys)
+
+    snapshots = []
+    for room_key in room_keys:
+        try:
+            snapshots.append(build_snapshot(flask_redis, room_key, room_versions[room_key]))
+        except KeyError:
+            continue
+    store_snapshots(flask_redis, snapshots)
+
+
+def load_snapshot(flask_redis, room_key):
+    """
+    Returns (snapshot, last_update) for a room, building the snapshot if it
+    has not been materialised yet.
+
+    Raises KeyError if the room does not exist.
+    """
+    snapshots, last_update = load_snapshots(flask_redis, [room_key])
+    return snapshots[room_key], last_update
+
+
+def load_snapshots(flask_redis, room_keys):
+    """
+    Returns ({room key: snapshot}, last_update) for the given rooms that
+    exist, read in one round trip. Snapshots that have not been
+    materialised yet are built and stored.
+    """
+    from map import schema, versions
+
+    rooms = [(schema.site_of(room_key), room_key) for room_key in room_keys]
+    rooms = [(site, room_key) for site, room_key in rooms if site is not None]
+
+    pipe = flask_redis.pipeline(transaction=False)
+    for site, room_key in rooms:
+        pipe.get(snapshot_key(site, room_key))
+    pipe.get("last-update")
+    *blobs, last_update = pipe.execute()
+
+    snapshots = {}
+    missing = []
+    for (site, room_key), blob in zip(rooms, blobs):
+        if blob is None:
+            missing.append(room_key)
+        else:
+            snapshots[room_key] = json.loads(blob)
+
+    if missing:
+        room_versions = versions.rooms(missing)
+        built = []
+        for room_key in missing:
+            try:
+                snapshots[room_key] = build_snapshot(flask_redis, room_key, room_versions[room_key])
+            except KeyError:
+                continue
+            built.append(snapshots[room_key])
+        store_snapshots(flask_redis, built)
+
+    return snapshots, last_update
@@ -87,20 +87,89 @@ function readyFunction(){
     });
 
     var timeNow
+    var lastUpdate = 0;
     var useCache = true;
 
     // Needs to be updated in css as well, find `fadeClasses`
     const fadeClasses = ".tabwrap, .mapp-pane-header > div, .mapp-pane-friends > table";
 
+    // Room layouts by id, for the compact /api/refresh format
+    var layouts = {};
+    const statusNames = ["offline", "online", "unknown"];
+
+    var runLengthDecode = function(encoded) {
+        const values = [];
+        for (let i = 0; i < encoded.length; i += 2) {
+            for (let n = 0; n < encoded[i + 1]; n++) {
+                values.push(encoded[i]);
+            }
+        }
+        return values;
+    };
+
+    var getLayout = function(site, id) {
+        if (layouts[id]) {
+            return $.Deferred().resolve(layouts[id]).promise();
+        }
+
+        return $.ajax({
+            url: `/api/layout?site=${site}&v=${id}`,
+        })
+        .then(function(layout) {
+            layouts[layout.id] = layout;
+            // the room changed since the refresh; the next one will match
+            return layout.id === id ? layout : $.Deferred().reject().promise();
+        });
+    };
+
+    // Expands a compact refresh into rows of cells, as the full format has them
+    var decodeRefresh = function(data, site) {
+        if (data.format !== "compact") {
+            return $.Deferred().resolve(data).promise();
+        }
+
+        return getLayout(site, data.layout).then(function(layout) {
+            const status = runLengthDecode(data.status);
+            const used = runLengthDecode(data.used);
+
+            const rows = [];
+            for (let y = 0; y < layout.rows; y++) {
+                const row = [];
+                for (let x = 0; x < layout.cols; x++) {
+                    row.push({});
+                }
+                rows.push(row);
+            }
+
+            const cells = layout.machines.map(function([y, x, hostname], i) {
+                const cell = {hostname: hostname, status: statusNames[status[i]]};
+                if (used[i]) {
+                    cell.user = "-";
+                }
+                rows[y][x] = cell;
+                return cell;
+            });
+
+            data.friends_at.forEach(([i, name]) => cells[i].friend = name);
+            data.cascaders_at.forEach(([i, name]) => cells[i].cascader = name);
+
+            data.rows = rows;
+            return data;
+        });
+    };
+
     var mapUpdate = function(){
         timeNow = new Date();
         var parts = location.pathname.split('/');
         var site = parts.pop() || parts.pop();  // handle potential trailing slash
 
         $.ajax({
-            url: `/api/refresh?site=${site}`,
+            url: `/api/refresh?site=${site}&format=compact`,
             cache: useCache,
         })
+        .then(function(data) {
+            return decodeRefresh(data, site);
+        })
         .done(function(data){
             console.log(data);
             $("#mapp-room-name").text(data.room.name);
@@ -109,6 +178,7 @@ function readyFunction(){
                 .removeClass("text-warning").removeClass('text-success')
                 .addClass(data.low_availability ? "text-warning" : "text-success");
             $("#mapp-num-machines").text(data.num_machines);
+            lastUpdate = data.last_update;
             const time = new Date(data.last_update * 1000);
             $("#mapp-last-update").attr("title", `Last update performed at ${dateFns.format(time)}`);
             $("#mapp-last-update > span").text(dateFns.distanceInWordsToNow(time, { addSuffix: true }));
@@ -256,7 +326,8 @@ function readyFunction(){
             type: 'POST',
             contentType: 'application/json',
             data: JSON.stringify({
-                timestamp : Date.now()
+                timestamp : Number(lastUpdate) || 0,
+                site : location.pathname.split('/').filter(Boolean).pop()
             }),
             dataType:'json'
         })
@@ -298,6 +369,42 @@ function readyFunction(){
         });
     }
 
+    var updateStream = null;
+    var pollTimer = null;
+
+    var startPolling = function() {
+        if (pollTimer === null) {
+            // Check for a refresh every five minutes
+            pollTimer = window.setInterval(checkRefreshAvailable, 5 * 60 * 1000);
+        }
+    };
+
+    var subscribeUpdates = function(room_key) {
+        if (updateStream !== null) {
+            updateStream.close();
+            updateStream = null;
+        }
+
+        if (!window.EventSource || !location.pathname.startsWith("/site/")) {
+            startPolling();
+            return;
+        }
+
+        const stream = new EventSource(`/api/events?site=${room_key}`);
+        stream.addEventListener("update", () => {
+            useCache = false;
+            mapUpdate();
+        });
+        stream.onerror = () => {
+            // The server answers 204 (closing the stream for good) when pushes are disabled
+            if (stream.readyState === EventSource.CLOSED) {
+                updateStream = null;
+                startPolling();
+            }
+        };
+        updateStream = stream;
+    };
+
     var switchRoom = function(room_key, pushState) {
         console.log(`Changing room to ${room_key}...`);
         gtag('set', 'page', location.pathname);
@@ -315,6 +422,7 @@ function readyFunction(){
 
             useCache = true;
             mapUpdate();
+            subscribeUpdates(room_key);
         })
     }
 
@@ -372,8 +480,6 @@ function readyFunction(){
         });
     }
 
-    // Check for a refresh every five minutes
-    window.setInterval(checkRefreshAvailable, 5 * 60 * 1000);
     /*Listeners*/
 
     $('#zoom-in').on('click',function(){
@@ -466,6 +572,7 @@ function readyFunction(){
     });
 
     mapUpdate();
+    subscribeUpdates(location.pathname.split('/').filter(Boolean).pop());
 
     cascadersReady();
 };
@@ -1,14 +1,5 @@
 from flask_login import UserMixin
 
-def check_uun_hash(uun, hash):
-    import hashlib
-    from config import CRYPTO_SECRET as secret
-
-    hasher = hashlib.sha512()
-    hasher.update((uun + str(secret)).encode("utf-8"))
-
-    return hasher.hexdigest() == hash
-
 
 class User(UserMixin):
     is_disabled = False
@@ -32,52 +23,74 @@ class User(UserMixin):
         return flask_redis.sismember("dnd-users", self.get_username())
 
     def set_dnd(self, state):
-        from map import flask_redis
+        from map import flask_redis, versions
 
         uun = self.get_username()
         if state:
             flask_redis.sadd("dnd-users", uun)
         else:
             flask_redis.srem("dnd-users", uun)
+        versions.bump(flask_redis, "dnd")
+
+    def get_hash(self):
+        if not hasattr(self, "_hash"):
+            from map import uun_hashes
+            self._hash = uun_hashes.hash(self.get_username())
+        return self._hash
+
+    def get_friends(self):
+        """Returns the set of friend uuns (cached for the lifetime of this request's user)"""
+        if not hasattr(self, "_friends"):
+            from map import flask_redis
+            self._friends = flask_redis.smembers(self.get_username()+'-friends')
+        return self._friends
 
     def get_friend(self, friend_hash, ignore_dnd=False):
-        from map import flask_redis
+        from map import flask_redis, uun_hashes
 
-        if check_uun_hash(self.get_username(), friend_hash):
+        if friend_hash == self.get_hash():
             if self.get_dnd() and not ignore_dnd:
                 return ""
             return self.get_username()
-        
-        all_friends = flask_redis.smembers(self.get_username()+'-friends')
-        
-        for friend in all_friends:
-            if check_uun_hash(friend, friend_hash):
-                from map import flask_redis
-                is_dnd = flask_redis.sismember("dnd-users", friend)
-                if is_dnd and not ignore_dnd:
-                    return ""
-                else:
-                    return friend
-        return ""
+
+        friend = uun_hashes.lookup(friend_hash)
+        if friend is None or friend not in self.get_friends():
+            return ""
+
+        is_dnd = flask_redis.sismember("dnd-users", friend)
+        if is_dnd and not ignore_dnd:
+            return ""
+        return friend
 
     def has_friend(self, friend_hash, ignore_dnd=False):
         return self.get_friend(friend_hash, ignore_dnd) != ""
 
     def cascade(self, enabled, tagline):
-        from map import flask_redis
+        from map import flask_redis, occupants, room_counts, uun_hashes, versions
 
         uun = self.get_username()
 
         if enabled:
-            flask_redis.sadd("cascaders.users", uun)
+            uun_hashes.add(uun)
+            changed = flask_redis.sadd("cascaders.users", uun)
         else:
-            flask_redis.srem("cascaders.users", uun)
+            changed = flask_redis.srem("cascaders.users", uun)
+
+        if changed:
+            # the machines they're logged in to gain or lose a cascader
+            uun_hash = uun_hashes.hash(uun)
+            pipe = flask_redis.pipeline(transaction=False)
+            for room_key in occupants.locate([uun_hash])[uun_hash].values():
+                room_counts.add_cascaders(pipe, room_key, 1 if enabled else -1)
+            pipe.execute()
 
         if not tagline:
             flask_redis.hdel("cascaders.taglines", uun)
         else:
             flask_redis.hset("cascaders.taglines", uun, tagline)
 
+        versions.bump(flask_redis, "cascaders")
+
 
 
 class DisabledUser(User):
@@ -0,0 +1,51 @@
+import hashlib
+
+
+class Versions():
+    """
+    Monotonic version counters for everything a map refresh depends on.
+
+    All counters live in the `versions` redis hash:
+    - `room.<key>`: bumped whenever that room's layout or state is written
+    - `rooms`: bumped alongside any room, since a refresh also shows friends
+      and cascaders elsewhere
+    - `friends.<uun>`: bumped when that user's friend list changes
+    - `cascaders`: bumped when anyone starts or stops cascading
+    - `dnd`: bumped when anyone flips do-not-disturb
+    """
+
+    key = "versions"
+
+    def __init__(self, flask_redis):
+        self.flask_redis = flask_redis
+
+    def bump(self, pipe, *fields):
+        """Queues an increment of each field on pipe (or runs it, given a client)"""
+        for field in fields:
+            pipe.hincrby(self.key, field, 1)
+
+    def bump_rooms(self, pipe, room_keys):
+        room_keys = list(room_keys)
+        if room_keys:
+            self.bump(pipe, "rooms", *["room." + room_key for room_key in room_keys])
+
+    def rooms(self, room_keys):
+        """Returns {room key: version} for the given rooms, in one round trip"""
+        room_keys = list(room_keys)
+        if not room_keys:
+            return {}
+        values = self.flask_redis.hmget(self.key, *["room." + room_key for room_key in room_keys])
+        return {room_key: int(value or 0) for room_key, value in zip(room_keys, values)}
+
+    def refresh_etag(self, room_keys, user, variant=""):
+        """Returns a strong ETag for /api/refresh of room_keys as seen by user, in a format variant"""
+        uun = user.get_username()
+        room_keys = list(room_keys)
+
+        pipe = self.flask_redis.pipeline(transaction=False)
+        pipe.hmget(self.key, "rooms", "friends." + uun, "cascaders", "dnd", *["room." + room_key for room_key in room_keys])
+        pipe.get("last-update")
+        versions, last_update = pipe.execute()
+
+        parts = [",".join(room_keys), uun, str(user.is_disabled), str(last_update), variant] + [str(v) for v in versions]
+        return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
@@ -1,13 +1,21 @@
-from map import app, flask_redis, ldap
-from .user import check_uun_hash
-from typing import List, Optional
+from map import app, api_keys, metrics, cosign, directory, flask_redis, friends_views, history, ldap, occupants, room_counts, schema, uun_hashes, versions
+from .concurrency import submit
+from .events import publish_room_updates, room_events
+from .history import RESOLUTIONS
+from .ingest import PushError, apply_updates, begin_push, end_push, machine, read_push
+from .sitedata import all_rooms, get_sites
+from .schema import SchemaError
+from .snapshot import write_snapshots, load_snapshot, load_snapshots
+from .wire import compact_refresh, grid_layout
+from collections import OrderedDict
+from typing import Optional, Set
 import time
 import hashlib
+import hmac
 import json, re
-from flask import render_template, request, jsonify, redirect, make_response
+from flask import render_template, request, jsonify, redirect, make_response, Response, stream_with_context
 from flask_login import login_user, logout_user, login_required, current_user
 import csv
-from collections import defaultdict
 
 class APIError(Exception):
     status_code = 401
@@ -32,77 +40,64 @@ def handle_invalid_usage(error):
     return response
 
 
-def get_cascaders() -> List[str]:
-    return list(flask_redis.smembers("cascaders.users"))
+def get_cascaders() -> Set[str]:
+    return flask_redis.smembers("cascaders.users")
 
 
-def find_cascader(cascaders: List[str], uun_hash: str) -> Optional[str]:
-    for uun in cascaders:
-        if check_uun_hash(uun, uun_hash):
-            return uun
+def find_cascader(cascaders: Set[str], uun_hash: str) -> Optional[str]:
+    uun = uun_hashes.lookup(uun_hash)
+    if uun in cascaders:
+        return uun
     return None
 
 
-def get_cascader_elsewhere_count(cascaders: List[str], notRoom: str) -> int:
-    rooms = filter(lambda name: name != notRoom, flask_redis.smembers("forresthill-rooms"))
-    rooms = map(lambda name: flask_redis.hgetall(name), rooms)
+def locate_cascaders(cascaders: Set[str]):
+    """Yields (uun, room) for every machine a cascader is logged in to"""
+    rooms = all_rooms()
+    cascaders = list(cascaders)
 
-    count: int = 0
+    locations = occupants.locate(uun_hashes.hash(uun) for uun in cascaders)
+    for uun, hosts in zip(cascaders, locations.values()):
+        for room_key in hosts.values():
+            if room_key in rooms:
+                yield uun, rooms[room_key]
 
-    for room in rooms:
-        room_machines = flask_redis.lrange(room['key'] + "-machines", 0, -1)
-        for machineName in room_machines:
-            machine = flask_redis.hgetall(machineName)
-            if machine['user']:
-                uun = find_cascader(cascaders, machine['user'])
-                if uun:
-                    count += 1
 
-    return count
+def get_cascader_elsewhere_count(notRoom: str) -> int:
+    """Counts machines outside notRoom with a cascader at them, from the room counters"""
+    return sum(counts['cascaders'] for room_key, counts in room_counts.all().items() if room_key != notRoom)
 
 
-def map_routine(which_room):
-    room = flask_redis.hgetall(str(which_room))
-    room_machines = flask_redis.lrange(room['key'] + "-machines", 0, -1)
-    machines = {m: flask_redis.hgetall(m) for m in room_machines}
-    num_rows = max([int(machines[m]['row']) for m in machines])
-    num_cols = max([int(machines[m]['col']) for m in machines])
+def map_routine(which_room, compact=False):
+    return map_rooms([which_room], compact)[which_room]
 
-    num_machines = len(machines.keys())
-    num_used = 0
 
-    rows = []
+def map_rooms(room_keys, compact=False):
+    """
+    Builds the /api/refresh view of each room, as {room key: view}, leaving
+    out rooms that don't exist.
+
+    Snapshots are read in one round trip, and friends, cascaders and the
+    names shown are looked up once for all the rooms, so refreshing many
+    rooms costs little more than refreshing one.
+    """
+    snapshots, last_update = load_snapshots(flask_redis, room_keys)
+    last_update = float(last_update or 0)
+
     uuns = set()
 
     cascaders = get_cascaders()
-    cascaders_here = set()
-
-    for r in range(0, num_rows+1):
-        unsorted_cells = []
-        for c in range(0, num_cols+1):
-            default_cell = {'hostname': None, 'col': c, 'row': r}
-            cell = [v for (k, v) in machines.items() if int(v['row']) == r and int(v['col']) == c]
-            if not cell:
-                cell = default_cell
-            else:
-                cell = cell[0]
+    cascaders_here = {}
 
-            try:
-                if cell['user'] is not "" or cell['status'] == "offline":
-                    num_used += 1
-            except Exception:
-                pass
-
-            if 'user' in cell:
-                if cell['user'] == "":
-                    del cell['user']
-                else:
+    for room_key, snapshot in snapshots.items():
+        here = cascaders_here[room_key] = set()
+        for cells in snapshot['rows']:
+            for cell in cells:
+                if 'user' in cell:
                     uun = find_cascader(cascaders, cell['user'])
                     if uun:
-                        cascaders_here.add(uun)
+                        here.add(uun)
                         cell["cascader"] = uun
-                    # else:
-                        # del cell["cascader"]
 
                     uun = current_user.get_friend(cell['user'])
                     if uun:
@@ -111,121 +106,115 @@ def map_routine(which_room):
                     else:
                         cell["user"] = "-"
 
-            unsorted_cells.append(cell)
-
-        cells = unsorted_cells
-        rows.append(cells)
-
-    uuns.update(cascaders_here)
-
-    uun_names = ldap.get_names(list(uuns))
-
-    for y in range(len(rows)):
-        for x in range(len(rows[y])):
-            cell = rows[y][x]
-            if "user" in cell:
-                uun = cell["user"]
-                if uun in uun_names:
-                    rows[y][x]["friend"] = uun_names[uun]
-
-            if "cascader" in cell:
-                uun = cell["cascader"]
-                if uun in uun_names:
-                    rows[y][x]["cascader"] = uun_names[uun]
-
-    num_free = num_machines - num_used
-
-    low_availability = num_free <= 0.3 * num_machines
-
-    last_update = float(flask_redis.get("last-update"))
-
-    # Annotate friends with "here" if they are here
-    room_key = room['key']
-    friends = get_friend_rooms()
-    friends_here, friends_elsewhere = (0, 0)
-    for i in range(len(friends)):
-        if friends[i]['room_key'] == room_key:
-            friends[i]['here'] = True
-            friends_here += 1
-        else:
-            friends_elsewhere += 1
-    
-    return {
-        "friends"          : friends,
-        "friends_here_count": friends_here,
-        "friends_elsewhere_count": friends_elsewhere,
-        "cascaders_here_count": len(cascaders_here),
-        "cascaders_elsewhere_count": get_cascader_elsewhere_count(cascaders, which_room),
-        "room"             : room,
-        "rows"             : rows,
-        "num_free"         : num_free,
-        "num_machines"     : num_machines,
-        "low_availability" : low_availability,
-        "last_update"      : last_update
-    }
+        uuns.update(here)
+
+    friends_rooms = locate_friends()
+    uuns.update(f[0] for f in friends_rooms)
+
+    # LDAP blocks, so resolve names on another thread while redis is used here
+    pending_names = submit(ldap.get_names, list(uuns))
+
+    # machines with a cascader at them, by room
+    cascader_rooms = {room_key: counts['cascaders'] for room_key, counts in room_counts.all().items()}
+    num_cascaders = sum(cascader_rooms.values())
+
+    uun_names = pending_names.result()
+    friends = name_friends(friends_rooms, uun_names)
+
+    views = {}
+    for room_key, snapshot in snapshots.items():
+        rows = snapshot['rows']
+        for cells in rows:
+            for cell in cells:
+                if "user" in cell:
+                    uun = cell["user"]
+                    if uun in uun_names:
+                        cell["friend"] = uun_names[uun]
+
+                if "cascader" in cell:
+                    uun = cell["cascader"]
+                    if uun in uun_names:
+                        cell["cascader"] = uun_names[uun]
+
+        # Annotate friends with "here" if they are here
+        room_friends = [dict(f, here=True) if f['room_key'] == room_key else f for f in friends]
+        friends_here = sum(1 for f in friends if f['room_key'] == room_key)
+
+        result = {
+            "friends"          : room_friends,
+            "friends_here_count": friends_here,
+            "friends_elsewhere_count": len(friends) - friends_here,
+            "cascaders_here_count": len(cascaders_here[room_key]),
+            "cascaders_elsewhere_count": num_cascaders - cascader_rooms.get(room_key, 0),
+            "room"             : snapshot['room'],
+            "rows"             : rows,
+            "num_free"         : snapshot['num_free'],
+            "num_machines"     : snapshot['num_machines'],
+            "low_availability" : snapshot['low_availability'],
+            "last_update"      : last_update
+        }
+
+        if compact:
+            result = compact_refresh(result, snapshot['layout_id'])
+        views[room_key] = result
+
+    return views
 
 
 def rooms_list():
     """Returns a tuple of (name, uun) (TODO: swap order)"""
-    rooms = list(flask_redis.smembers("forresthill-rooms"))
-    rooms.sort()
-    for i in range(len(rooms)):
-        room = rooms[i]
-        rooms[i] = (room, flask_redis.hget(room, "name"))
-
-    return rooms
+    return [(key, room['name']) for site in get_sites() for key, room in site.rooms.items()]
 
 def room_machines(which):
-    machines = flask_redis.lrange(which + "-machines", 0, -1)
-    return machines
-
-def get_friends():
-    friends = flask_redis.smembers(current_user.get_username() + "-friends")
-    friends = list(friends)
-
-    with ldap.conn() as ldap_conn:
-        friend_names = ldap.get_names_bare(friends, ldap_conn)
-
-        for i in range(len(friends)):
-            uun = friends[i]
-            friend = uun
-
-            if uun in friend_names:
-                friend = friend_names[uun]
+    try:
+        return [m['hostname'] for m in schema.room(which)['machines']]
+    except KeyError:
+        return []
 
-            friends[i] = (friend, uun)
+def locate_friends():
+    """Returns (uun, room key, room name) for each room the user or a friend is logged in at"""
+    friends_rooms = set()
+    if current_user.is_authenticated:
+        rooms = all_rooms()
+        uuns = current_user.get_friends() | {current_user.get_username()}
+
+        locations = occupants.locate(uun_hashes.hash(uun) for uun in uuns)
+        for uun_hash, hosts in locations.items():
+            if not hosts:
+                continue
+
+            uun = current_user.get_friend(uun_hash)
+            if not uun:
+                continue
+
+            for room_key in hosts.values():
+                if room_key in rooms:
+                    friends_rooms.add((uun, room_key, rooms[room_key]['name']))
+    return list(friends_rooms)
+
+def name_friends(friends_rooms, names):
+    """Turns locate_friends() into the friends list of a refresh, given uun -> name"""
+    friends = [
+        {
+            'uun': uun,
+            'name': names[uun],
+            'room_key': room_key,
+            'room_name': room_name
+        }
+        for uun, room_key, room_name in friends_rooms
+        if uun in names
+    ]
+    friends.sort(key=lambda x: x['name'])
     return friends
 
 def get_friend_rooms():
-    rooms = map(lambda name: flask_redis.hgetall(name), flask_redis.smembers("forresthill-rooms"))
-    rooms = sorted(rooms, key=lambda x: x['key'])
+    if not current_user.is_authenticated:
+        return set()
 
-    friends_rooms = set()
-    if current_user.is_authenticated:
-        for room in rooms:
-            room_machines = flask_redis.lrange(room['key'] + "-machines", 0, -1)
-            for machineName in room_machines:
-                machine = flask_redis.hgetall(machineName)
-                if current_user.has_friend(machine['user']):
-                    uun = current_user.get_friend(machine['user'])
-                    friends_rooms.add((uun, room['key'], room['name']))
-        friends_rooms = list(friends_rooms)
-
-        # uun -> name
-        names = ldap.get_names([f[0] for f in friends_rooms])
-        for i in range(len(friends_rooms)):
-            uun, b, c = friends_rooms[i]
-            if uun in names:
-                friends_rooms[i] = {
-                    'uun': uun,
-                    'name': names[uun],
-                    'room_key': b,
-                    'room_name': c
-                }
-
-        friends_rooms.sort(key=lambda x: x['name'])
-
-    return friends_rooms
+    friends_rooms = locate_friends()
+    # uun -> name
+    names = ldap.get_names([f[0] for f in friends_rooms])
+    return name_friends(friends_rooms, names)
 
 @app.route("/")
 def index():
@@ -245,41 +234,96 @@ def site(which):
     if which == "":
         which = default
 
-    room = flask_redis.hgetall(str(which))
-    if room == {}:
+    if schema.site_of(str(which)) is None:
         return '404'
         
     return render_template('site.html',
-                           room_key=room['key'])
+                           room_key=which)
 
 # WARNING!!!! THIS METHOD IS UNAUTHENTICATED!!!!!
 @app.route('/api/refresh')
 def refresh_data():
     """
     Returns a new update
+
+    ?site= names one room, several as site=a,b,c, or every room as
+    site=all. Several rooms come back as {"rooms": {room key: update},
+    "missing": [rooms that don't exist]}.
     """
     default = "drillhall"
     which = request.args.get('site', '')
+    batch = which == "all" or "," in which
+    # ?format=compact splits the grid into a layout and run-length encoded state, see map/wire.py
+    compact = request.args.get('format') == "compact"
 
     # SENSITIVE CODE!!!!
     # THIS IS_ANONYMOUS CHECK IS WHAT GUARDS
     # AGAINST NON-LOGGED IN ACCESS
     is_demo = True
+    etag = None
     if current_user.is_anonymous or which == "":
         this = get_demo_json()
     else:
-        try:
-            this = map_routine(which)
+        if which == "all":
+            room_keys = sorted(all_rooms())
+        else:
+            room_keys = list(OrderedDict.fromkeys(key for key in which.split(",") if key))
+
+        etag = versions.refresh_etag(room_keys, current_user, "compact" if compact else "")
+        if request.if_none_match.contains_weak(etag):
+            resp = make_response("", 304)
+            resp.set_etag(etag)
+            resp.cache_control.max_age = 60
+            return resp
+
+        if batch:
+            rooms = map_rooms(room_keys, compact)
+            this = {
+                "rooms": rooms,
+                "missing": [key for key in room_keys if key not in rooms],
+            }
             is_demo = False
-        except KeyError:
-            this = get_demo_json()
+        else:
+            try:
+                this = map_routine(which, compact)
+                is_demo = False
+            except KeyError:
+                this = get_demo_json()
 
     resp = make_response(jsonify(this))
     if not is_demo:
+        resp.set_etag(etag)
         resp.cache_control.max_age = 60
 
     return resp
 
+@app.route('/api/layout')
+@login_required
+def room_layout():
+    """
+    Returns the fixed part of a room's grid, which compact refreshes refer
+    to by id. A layout never changes under its id, so when the id is given
+    as ?v= the response may be cached for good.
+    """
+    which = request.args.get('site', '')
+    try:
+        snapshot, _ = load_snapshot(flask_redis, which)
+    except KeyError:
+        raise APIError("No such room", status_code=404)
+
+    layout = snapshot['layout_id']
+    if request.if_none_match.contains_weak(layout):
+        resp = make_response("", 304)
+    else:
+        resp = jsonify(dict(grid_layout(snapshot['rows']), id=layout))
+    resp.set_etag(layout)
+
+    if request.args.get('v') == layout:
+        resp.headers['Cache-Control'] = "private, max-age=31536000, immutable"
+    else:
+        resp.cache_control.no_cache = True
+    return resp
+
 @app.route("/login", methods=['GET'])
 def login():
     url = "https://weblogin.inf.ed.ac.uk/cosign-bin/cosign.cgi?cosign-betterinformatics.com&" + request.url_root
@@ -300,29 +344,23 @@ def route_get_cascaders():
         return jsonify([])
 
     cascaders = get_cascaders()
-
-    rooms = map(lambda name: flask_redis.hgetall(name), flask_redis.smembers("forresthill-rooms"))
     result = []
 
-    for room in rooms:
-        room_machines = flask_redis.lrange(room['key'] + "-machines", 0, -1)
-        for machineName in room_machines:
-            machine = flask_redis.hgetall(machineName)
-            if machine['user']:
-                uun = find_cascader(cascaders, machine['user'])
-                if uun:
-                    result.append({
-                        'uun': uun,
-                        'room': room['name'],
-                    })
+    for uun, room in locate_cascaders(cascaders):
+        result.append({
+            'uun': uun,
+            'room': room['name'],
+        })
 
     uuns = [f['uun'] for f in result]
 
-    # uun -> name
-    names = ldap.get_names(uuns)
+    # uun -> name, looked up while the taglines are fetched
+    pending_names = submit(ldap.get_names, uuns)
 
     # uun -> tagline
-    taglines = flask_redis.hmget("cascaders.taglines", uuns)
+    taglines = flask_redis.hmget("cascaders.taglines", uuns) if uuns else []
+
+    names = pending_names.result()
 
     for i in range(len(result)):
         uun = result[i]['uun']
@@ -357,6 +395,10 @@ def route_get_cascaders_info():
 
 @app.route("/logout")
 def logout():
+    login_token = request.cookies.get("cosign-betterinformatics.com")
+    if login_token:
+        cosign.invalidate(login_token, request.remote_addr)
+
     resp = make_response(redirect(request.args.get('next','/')))
     resp.set_cookie("cosign-betterinformatics.com", "", domain="betterinformatics.com", expires=0)
     return resp
@@ -375,6 +417,13 @@ def rooms(which=""):
         return jsonify({"machines":machines})
     
 
+def check_callback_key(key):
+    if not api_keys.check(key):
+        # HTTP 401 Not Authorised
+        print("******* CLIENT ATTEMPTED TO USE BAD KEY *******")
+        raise APIError("Given key is not an authorised API key")
+
+
 @app.route('/api/update_schema', methods=['POST'])
 def update_schema():
     content = request.json
@@ -384,10 +433,7 @@ def update_schema():
     except Exception:
         key = ""
 
-    if key not in flask_redis.lrange("authorised-key", 0, -1):
-        # HTTP 401 Not Authorised
-        print("******* CLIENT ATTEMPTED TO USE BAD KEY *******")
-        raise APIError("Given key is not an authorised API key")
+    check_callback_key(key)
 
     try:
         sheetInput = content['machines']
@@ -406,8 +452,8 @@ def update_schema():
 
     roomKeys = ['site', 'key', 'name']
 
-    pipe = flask_redis.pipeline()
-    sites = defaultdict(list)
+    rooms = []
+    drop = []
 
     for sheet in sheetInput:
         preader = csv.reader(sheet['csv'].split('\r\n'), delimiter=',')
@@ -444,74 +490,32 @@ def update_schema():
                         'hostname': hostname,
                         'col': colnumber,
                         'row': rownumber-3, # -3 required because first 3 rows are headers
-                        'user': '',
-                        'timestamp': '',
-                        'status': 'offline',
-                        'site': room['site'],
-                        'room': room['key'],
                     })
 
-        # if we aren't resetting the entire schema, reset just this room first
-        if not resetAll:
-            schema_reset_room(pipe, room['site'], room['key'], dropFromSite=True)
-
-        # if dropping only, continue
+        # if dropping only, just take the room away
         if dropOnly:
+            drop.append(room['key'])
             continue
 
-        # add site to list of sites
-        pipe.sadd('mapp.sites', room['site'])
-        # add room to site
-        pipe.sadd(room['site']+'-rooms', room['key'])
-        # add room dict
-        pipe.hmset(room['key'], room)
-        # add room machine listing
-        pipe.lpush(room['key'] + '-machines', *map(lambda m: m['hostname'], machines))
-        # add each machine
-        for m in machines:
-            pipe.hmset(m['hostname'], m)
-
-        sites[room['site']].append(room)
-
-    if resetAll:
-        schema_reset(site="forresthill")
-
-    pipe.execute()
-
-    return jsonify({'success': True})
-
-"""
-    schema_reset completely resets the schema for a site.
-
-    - list site rooms
-        - list room machines
-            - remove machine entries
-        - remove room entry
-    - remove site entry
-
-"""
-def schema_reset(site):
-    siteKey = site + "-rooms"
-    pipe = flask_redis.pipeline()
-
-    for room in flask_redis.smembers(siteKey):
-        schema_reset_room(pipe, site, room)
-
-    pipe.delete(site)
-    pipe.srem("mapp.sites", site)
+        rooms.append({'room': room, 'machines': machines})
 
+    # build and validate the new layout out of sight, then make it live at once
+    try:
+        changed = schema.load(rooms, drop=drop, reset=resetAll)
+    except SchemaError as e:
+        raise APIError(str(e), status_code=400)
+    room_keys = [room_key for _, room_key in changed]
+
+    write_snapshots(flask_redis, room_keys)
+
+    now = time.time()
+    pipe = flask_redis.pipeline(transaction=False)
+    for room_key in room_keys:
+        pipe.hset("room-updates", room_key, now)
+    publish_room_updates(pipe, room_keys, now)
     pipe.execute()
 
-def schema_reset_room(pipe, site, room, dropFromSite=False):
-    roomKey = room+"-machines"
-    machines = flask_redis.lrange(roomKey, 0, -1)
-    if len(machines) > 0:
-        pipe.delete(*machines)
-    pipe.delete(roomKey)
-    pipe.delete(room)
-
-    if dropFromSite:
-        pipe.srem(site+'-rooms', room)
+    return jsonify({'success': True, 'changed_rooms': room_keys})
 
 
 @app.route('/api/update', methods=['POST'])
@@ -523,32 +527,110 @@ def update():
     except Exception:
         key = ""
 
-    if key not in flask_redis.lrange("authorised-key", 0, -1):
-        # HTTP 401 Not Authorised
-        print("******* CLIENT ATTEMPTED TO USE BAD KEY *******")
-        raise APIError("Given key is not an authorised API key") 
+    check_callback_key(key)
 
-    pipe = flask_redis.pipeline()
-    
     try:
-        for machine in content['machines']:
-            host   = machine['hostname']
-            user   = machine['user']
-            ts     = machine['timestamp']
-            status = machine['status']
-
-            pipe.hset(host, "user", user)
-            pipe.hset(host, "timestamp", ts)
-            pipe.hset(host, "status", status)
-
+        # normalised like bulk pushes, so values compare equal to what is stored
+        machines = [machine(m) for m in content['machines']]
     except Exception:
-        print("Malformed JSON content")
+        app.logger.warning("Malformed JSON content in /api/update")
         raise APIError("Malformed JSON content", status_code=400)
 
-    pipe.set("last-update", time.time())
-    pipe.execute()
+    summary = apply_updates(flask_redis, machines, app.config.get("INGEST_BATCH_SIZE", 500))
 
-    return jsonify(status="ok")
+    return jsonify(status="ok", changes=summary)
+
+@app.route('/api/update/bulk', methods=['POST'])
+def bulk_update():
+    """
+    Streamed, compressed equivalent of /api/update for large pushes.
+
+    The key goes in X-Callback-Key, as the body is only read as it is
+    applied. A worker may number its pushes with X-Push-Sequence within
+    the run named by X-Worker-Id (both are needed), making retries safe: a push that has
+    already been applied, or is older than one that has, is acknowledged
+    without being applied again.
+    """
+    check_callback_key(request.headers.get('X-Callback-Key', ''))
+
+    worker = request.headers.get('X-Worker-Id')
+    sequence = request.headers.get('X-Push-Sequence')
+    if sequence is not None:
+        try:
+            sequence = int(sequence)
+        except ValueError:
+            raise APIError("X-Push-Sequence must be an integer", status_code=400)
+        # a restarted worker numbers from 1 again, so its runs must not share a name
+        if not worker:
+            raise APIError("X-Push-Sequence needs an X-Worker-Id", status_code=400)
+
+        claim = begin_push(flask_redis, worker, sequence)
+        if claim == "duplicate":
+            return jsonify(status="duplicate", sequence=sequence)
+        if claim == "in-progress":
+            # HTTP 409 Conflict: the original is still being applied, retry later
+            raise APIError("Push %d is already being applied" % sequence, status_code=409)
+
+    applied = False
+    try:
+        machines = read_push(request.stream, request.headers.get('Content-Encoding', ''), request.mimetype)
+        summary = apply_updates(flask_redis, machines, app.config.get("INGEST_BATCH_SIZE", 500))
+        applied = True
+    except PushError as e:
+        app.logger.warning("Bad bulk push: %s", e.message)
+        raise APIError(e.message, status_code=e.status_code)
+    finally:
+        if sequence is not None:
+            end_push(flask_redis, worker, sequence, applied)
+
+    return jsonify(status="ok", sequence=sequence, changes=summary)
+
+@app.route("/api/events")
+@login_required
+def events():
+    """Server-Sent Events stream that notifies the client when a room changes"""
+    which = request.args.get('site', '')
+    if not app.config.get("SSE_ENABLED", False) or which == "":
+        # 204 tells EventSource not to reconnect, so the client falls back to polling
+        return "", 204
+
+    resp = Response(stream_with_context(room_events(flask_redis, which)), mimetype="text/event-stream")
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
+@app.route("/api/history/<room>")
+@login_required
+def room_history(room):
+    """
+    Occupancy history of a room: average free/used/offline counts per bucket.
+
+    ?resolution= is 5m, 1h (the default) or 1d, between ?start= and ?end=
+    (unix times, defaulting to the last 288 buckets up to now); "weekly" for
+    averages by weekday and hour, or "raw" for the latest ?limit= samples.
+    """
+    site = schema.site_of(room)
+    if site is None:
+        raise APIError("No such room", status_code=404)
+
+    resolution = request.args.get("resolution", "1h")
+    if resolution == "weekly":
+        return jsonify(room=room, resolution=resolution, buckets=history.profile(site, room))
+    if resolution == "raw":
+        limit = request.args.get("limit", 288, type=int)
+        if limit < 1:
+            raise APIError("Ask for at least 1 sample", status_code=400)
+        return jsonify(room=room, resolution=resolution, samples=history.recent(site, room, limit))
+    if resolution not in RESOLUTIONS:
+        raise APIError("Unknown resolution, expected one of %s" % ", ".join(list(RESOLUTIONS) + ["weekly", "raw"]), status_code=400)
+
+    width, _ = RESOLUTIONS[resolution]
+    end = request.args.get("end", time.time(), type=float)
+    start = request.args.get("start", end - 287 * width, type=float)
+    if end < start or (end - start) / width > 2000:
+        raise APIError("Ask for between 1 and 2000 buckets", status_code=400)
+
+    return jsonify(room=room, resolution=resolution, buckets=history.rollup(site, room, resolution, start, end))
 
 @app.route("/api/update_available", methods=['POST'])
 @login_required
@@ -561,32 +643,44 @@ def update_available():
     except Exception as e:
         raise APIError("Malformed JSON POST data", status_code=400)
 
-    last_update = float(flask_redis.get("last-update"))
-    user_behind = client_time < last_update
+    # only rooms that actually changed move their timestamp forward
+    if content.get('site'):
+        last_update = flask_redis.hget("room-updates", content['site'])
+    else:
+        last_update = flask_redis.get("last-update")
+    user_behind = client_time < float(last_update or 0)
 
     return jsonify(status=str(user_behind))
 
 @app.route("/api/friends", methods=['GET', 'POST'])
 @login_required
 def friends():
+    uun = current_user.get_username()
+
     if request.method == "POST":
        formtype = request.form.get('type')
        if formtype == "del":
            remove_friends = request.form.getlist('delfriends[]')
-           flask_redis.srem(current_user.get_username() + "-friends", *remove_friends)
+           friends_views.change(uun, remove=remove_friends)
        elif formtype == "add":
            add_friend = request.form.get('uun')
 
            #if(re.match("^[A-Za-z]+\ [A-Za-z]+$", add_friend) == None):
            #    raise APIError("Friend name expected in [A-z]+\ [A-z]+ form.", status_code=400)
-           flask_redis.sadd(current_user.get_username() + "-friends", add_friend)
-
-    friends = get_friends()
-    friends = map(lambda p: ("%s (%s)" % (p[0], p[1]), p[1]), friends)
+           friends_views.change(uun, add=[add_friend])
 
-    friends = sorted(friends, key=lambda s: s[0].lower())
+    version, friends = friends_views.get(uun)
 
-    return jsonify(friendList=friends) #Set up for ajax responses
+    # the version only moves when the list does, so clients can revalidate
+    # with If-None-Match and skip unchanged lists
+    etag = hashlib.sha1(("%s|%d" % (uun, version)).encode("utf-8")).hexdigest()
+    if request.method == "GET" and request.if_none_match.contains_weak(etag):
+        resp = make_response("", 304)
+    else:
+        resp = jsonify(friendList=[(f['name'], f['uun']) for f in friends], version=version) #Set up for ajax responses
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = "private, no-cache"
+    return resp
 
 
 @app.route("/api/search", methods=['GET'])
@@ -596,22 +690,39 @@ def search_friends():
     if len(name) < 2:
         return jsonify(people=[])
 
-    people = sorted(ldap.search_name(name), key=lambda p: p['name'].lower())
-    friends = get_friends()
+    people = directory.search(name)
+    if people is None:
+        people = sorted(ldap.search_name(name), key=lambda p: p['name'].lower())
+    friends = current_user.get_friends()
 
     for person in people:
-        if (person['name'], person['uun']) in friends:
+        if person['uun'] in friends:
             person['friend'] = True
 
     return jsonify(people=people) #Set up for ajax responses
 
     
+@app.route("/metrics")
+def metrics_export():
+    token = app.config.get("METRICS_TOKEN")
+    if token and not hmac.compare_digest(request.headers.get("Authorization", ""), "Bearer " + token):
+        raise APIError("Not allowed", status_code=403)
+
+    body, content_type = metrics.export()
+    return Response(body, content_type=content_type)
+
 @app.route("/demo")
 def demo():
-    return render_template(
-        "site.html",
-        room_key="Demo"
-    )
+    # logged out, the demo page is the same for everyone, so render it once
+    if not current_user.is_anonymous or app.debug:
+        return render_template("site.html", room_key="Demo")
+
+    global demo_page
+    if demo_page is None:
+        demo_page = render_template("site.html", room_key="Demo")
+    return demo_page
+
+demo_page = None
 
 def get_demo_friends():
     return [
@@ -0,0 +1,47 @@
+import time
+
+# uuns looked up in each LDAP query while warming the name cache
+NAMES_BATCH = 200
+
+
+def warm_up():
+    """
+    Fills this process's caches before it serves anything, so a new
+    worker's first requests are as quick as the rest:
+    - every live layout and the hostname and room indexes (which is all the
+      room list needs);
+    - the compiled templates;
+    - the directory snapshot /api/search answers from;
+    - the uun hash index, and the names of every friend and cascader who is
+      logged in somewhere, in memory and in the shared redis cache.
+
+    Under gunicorn --preload this runs once, in the master, and every
+    worker starts with its result. Returns a summary of what was loaded.
+    """
+    from map import app, directory, ldap, occupants, schema, uun_hashes
+
+    start = time.perf_counter()
+
+    layouts = schema.warm()
+
+    templates = app.jinja_env.list_templates()
+    for name in templates:
+        app.jinja_env.get_template(name)
+
+    directory.load()
+
+    # LDAP last, so the rest is warm even if it is unreachable
+    uun_hashes.sync()
+    located = occupants.locate(uun_hashes.hashes)
+    uuns = sorted(uun_hashes.hashes[uun_hash] for uun_hash, hosts in located.items() if hosts)
+    for i in range(0, len(uuns), NAMES_BATCH):
+        ldap.get_names(uuns[i:i + NAMES_BATCH])
+
+    return {
+        "sites": len(layouts),
+        "rooms": sum(len(rooms) for rooms in layouts.values()),
+        "templates": len(templates),
+        "people": len(directory.snapshot.people),
+        "names": len(uuns),
+        "seconds": time.perf_counter() - start,
+    }
@@ -0,0 +1,117 @@
+import gzip
+import hashlib
+import json
+
+# machine statuses as sent in the compact format; anything else is UNKNOWN
+STATUS_CODES = {"offline": 0, "online": 1}
+UNKNOWN = 2
+
+COMPACT_VERSION = 1
+
+# response bodies smaller than this aren't worth compressing
+COMPRESS_MIN_SIZE = 1024
+COMPRESSIBLE = ("application/json", "text/html", "text/plain", "text/css", "application/javascript")
+
+
+def grid_layout(rows):
+    """
+    The fixed part of a room's grid: its size, and (row, col, hostname) of
+    each machine in row-major order. Machine state in the compact format is
+    listed in this order.
+    """
+    return {
+        "rows": len(rows),
+        "cols": max((len(cells) for cells in rows), default=0),
+        "machines": [
+            [y, x, cell['hostname']]
+            for y, cells in enumerate(rows)
+            for x, cell in enumerate(cells)
+            if cell.get('hostname')
+        ],
+    }
+
+
+def layout_id(rows):
+    layout = json.dumps(grid_layout(rows), separators=(",", ":"))
+    return hashlib.sha1(layout.encode("utf-8")).hexdigest()[:16]
+
+
+def run_length(values):
+    """Encodes values as a flat list of value, count, value, count..."""
+    encoded = []
+    for value in values:
+        if encoded and encoded[-2] == value:
+            encoded[-1] += 1
+        else:
+            encoded += [value, 1]
+    return encoded
+
+
+def compact_refresh(data, layout):
+    """
+    Re-encodes a /api/refresh response (as built by map_routine) in the
+    compact format, where the grid is replaced by:
+    - `layout`: the id of the room's layout, from /api/layout
+    - `status`: run-length encoded status codes of each machine
+    - `used`: run-length encoded 1 or 0 for whether each machine is in use
+    - `friends` / `cascaders` at machines: [index, name] for just those
+      machines
+    Machines are indexed in layout order.
+    """
+    cells = [cell for cells in data['rows'] for cell in cells if cell.get('hostname')]
+
+    compact = {key: value for key, value in data.items() if key != 'rows'}
+    compact.update({
+        "format": "compact",
+        "version": COMPACT_VERSION,
+        "layout": layout,
+        "status": run_length([STATUS_CODES.get(cell.get('status'), UNKNOWN) for cell in cells]),
+        "used": run_length([1 if cell.get('user') else 0 for cell in cells]),
+        "friends_at": [[i, cell['friend']] for i, cell in enumerate(cells) if cell.get('friend')],
+        "cascaders_at": [[i, cell['cascader']] for i, cell in enumerate(cells) if cell.get('cascader')],
+    })
+    return compact
+
+
+def accepted_encoding(request):
+    """Picks the best response compression the client accepts, or None"""
+    accepted = request.accept_encodings
+    if accepted['br']:
+        try:
+            import brotli  # noqa: F401
+            return "br"
+        except ImportError:
+            pass
+    if accepted['gzip']:
+        return "gzip"
+    return None
+
+
+def compress(request, response):
+    """
+    Compresses a complete response body with brotli or gzip, if the client
+    accepts either and it is worth it. A strong ETag becomes weak, as the
+    bytes are no longer those it was computed for.
+    """
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE):
+        return response
+
+    response.vary.add("Accept-Encoding")
+
+    body = response.get_data()
+    encoding = accepted_encoding(request)
+    if encoding is None or len(body) < COMPRESS_MIN_SIZE:
+        return response
+
+    if encoding == "br":
+        import brotli
+        response.set_data(brotli.compress(body, quality=5))
+    else:
+        response.set_data(gzip.compress(body, compresslevel=6))
+    response.headers['Content-Encoding'] = encoding
+
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
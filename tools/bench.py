@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+"""
+Microbenchmarks for the map and the friends/cascader paths.
+
+Fills a redis database with a synthetic site, then times map_routine,
+map_rooms (every room at once), get_friend_rooms,
+get_cascader_elsewhere_count, route_get_cascaders and /api/update
+ingestion, each inside its own request context (so per-request caches
+start cold, like they would in production). LDAP and CoSign are replaced
+with in-process fakes.
+
+Results (latency percentiles in milliseconds, and redis round trips and
+commands per call) are printed and can be saved as JSON to compare commits:
+
+    python tools/bench.py --output before.json
+    git checkout my-branch
+    python tools/bench.py --output after.json --compare before.json
+
+The target redis database is FLUSHED, so point --redis-url at a scratch
+database, or use --fakeredis to run against an in-memory stand-in (needs the
+fakeredis package).
+"""
+import argparse
+import contextlib
+import gzip
+import hashlib
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CRYPTO_SECRET = "bench"
+CALLBACK_KEY = "bench"
+
+
+class FakeLDAPConnection():
+    """Answers the uid lookups LDAPTools makes with made-up names"""
+
+    def search_s(self, base, scope, query, attrs):
+        import re
+        uids = re.findall(r"uid=([^)*]+)\)", query)
+        return [
+            ("uid=%s" % uid, {'uid': [uid.encode()], 'gecos': [("Student %s" % uid).encode()]})
+            for uid in uids
+        ]
+
+
+class FakeConnectionManager():
+    @contextlib.contextmanager
+    def connection(self, *args, **kwargs):
+        yield FakeLDAPConnection()
+
+
+def install_config(redis_url):
+    """Provides the app's config module, so the bench never reads config.py"""
+    config = types.ModuleType("config")
+    config.SECRET_KEY = os.urandom(32)
+    config.DICE_API_NAME = "bench"
+    config.DICE_API_KEY = "bench"
+    config.LDAP_SERVER = "ldap://localhost"
+    config.REDIS_URL = redis_url
+    config.CRYPTO_SECRET = CRYPTO_SECRET
+    sys.modules["config"] = config
+
+
+def uun_hash(uun):
+    return hashlib.sha512((uun + CRYPTO_SECRET).encode("utf-8")).hexdigest()
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+
+    def pick(p):
+        return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))]
+
+    return {
+        'min': samples[0],
+        'p50': pick(50),
+        'p90': pick(90),
+        'p99': pick(99),
+        'max': samples[-1],
+        'mean': sum(samples) / len(samples),
+    }
+
+
+class Bench():
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+
+        install_config(args.redis_url)
+
+        import map
+        from map.user import User
+
+        self.map = map
+        self.app = map.app
+        self.client = self.app.test_client()
+
+        if args.fakeredis:
+            import fakeredis
+            map.flask_redis._redis_client.connection_pool = fakeredis.FakeStrictRedis(decode_responses=True).connection_pool
+
+        map.ldap.cm = FakeConnectionManager()
+        map.cosign.getuser = lambda login_token, ip: User(login_token, {
+            'Principal': login_token,
+            'Realm': 'INF.ED.AC.UK',
+        })
+
+    def uun(self, i):
+        return "s%07d" % i
+
+    def populate(self):
+        args = self.args
+        redis = self.map.flask_redis
+
+        redis.flushdb()
+        redis.lpush("authorised-key", CALLBACK_KEY)
+
+        # lay each room out as a square-ish grid
+        width = max(1, int(args.machines ** 0.5))
+        sheets = []
+        self.hosts = []
+        for r in range(args.rooms):
+            hosts = ["r%dm%d" % (r, m) for m in range(args.machines)]
+            self.hosts.extend(hosts)
+
+            lines = ["site,key,name", "forresthill,room%d,Room %d" % (r, r), ""]
+            for i in range(0, len(hosts), width):
+                lines.append(",".join(hosts[i:i+width]))
+            sheets.append({'name': 'room%d' % r, 'csv': "\r\n".join(lines)})
+
+        self.rooms = ["room%d" % r for r in range(args.rooms)]
+
+        resp = self.client.post('/api/update_schema', json={
+            'callback-key': CALLBACK_KEY,
+            'machines': sheets,
+            'resetAll': False,
+            'dropOnly': False,
+        })
+        assert resp.status_code == 200, resp.data
+
+        # the population of students who might be sitting down
+        self.population = [self.uun(i) for i in range(max(args.population, len(self.hosts)))]
+
+        self.me = self.population[0]
+        friends = self.random.sample(self.population[1:], args.friends)
+        cascaders = self.random.sample(self.population[1:], args.cascaders)
+
+        if friends:
+            redis.sadd(self.me + "-friends", *friends)
+        if cascaders:
+            redis.sadd("cascaders.users", *cascaders)
+        self.map.uun_hashes.rebuild()
+
+        self.push(self.occupancy())
+
+    def occupancy(self):
+        """A fresh random state for every machine"""
+        machines = []
+        sitting = iter(self.random.sample(self.population, len(self.hosts)))
+        for host in self.hosts:
+            user = next(sitting)
+            occupied = self.random.random() < self.args.occupancy
+            machines.append({
+                'hostname': host,
+                'user': uun_hash(user) if occupied else "",
+                'timestamp': str(int(time.time())),
+                'status': 'online' if self.random.random() > 0.05 else 'offline',
+            })
+        return machines
+
+    def push(self, machines):
+        resp = self.client.post('/api/update', json={
+            'callback-key': CALLBACK_KEY,
+            'machines': machines,
+        })
+        assert resp.status_code == 200, resp.data
+
+    def time(self, name, fn, path="/"):
+        """Times fn() in a fresh, logged in request context per iteration"""
+        from flask import g
+        from flask_login import current_user
+
+        samples = []
+        roundtrips = []
+        commands = []
+
+        for i in range(self.args.warmup + self.args.iterations):
+            headers = {'Cookie': 'cosign-betterinformatics.com=' + self.me}
+            with self.app.test_request_context(path, headers=headers):
+                current_user.get_username()
+
+                start = time.perf_counter()
+                fn()
+                elapsed = (time.perf_counter() - start) * 1000
+
+                if i >= self.args.warmup:
+                    samples.append(elapsed)
+                    roundtrips.append(g.get('redis_roundtrips', 0))
+                    commands.append(g.get('redis_commands', 0))
+
+        result = percentiles(samples)
+        result['redis_roundtrips'] = sum(roundtrips) / len(roundtrips)
+        result['redis_commands'] = sum(commands) / len(commands)
+        return result
+
+    def run(self):
+        from map import views
+
+        room = self.rooms[0]
+        results = {}
+
+        results['map_routine'] = self.time('map_routine', lambda: views.map_routine(room))
+        results['map_routine_compact'] = self.time('map_routine_compact', lambda: views.map_routine(room, compact=True))
+        results['map_rooms'] = self.time('map_rooms', lambda: views.map_rooms(self.rooms))
+        results['get_friend_rooms'] = self.time('get_friend_rooms', views.get_friend_rooms)
+        results['get_cascader_elsewhere_count'] = self.time(
+            'get_cascader_elsewhere_count',
+            lambda: views.get_cascader_elsewhere_count(room))
+        results['route_get_cascaders'] = self.time('route_get_cascaders', views.route_get_cascaders)
+
+        # ingest a new state per iteration, with a share of machines changing
+        states = [self.occupancy() for _ in range(self.args.warmup + self.args.iterations)]
+        current = states[0]
+        pushes = []
+        for state in states:
+            current = [new if self.random.random() < self.args.churn else old for old, new in zip(current, state)]
+            pushes.append(current)
+        pushes_bulk = pushes[::-1]
+        pushes = iter(pushes)
+
+        def ingest():
+            with self.app.test_request_context('/api/update', method='POST', json={
+                'callback-key': CALLBACK_KEY,
+                'machines': next(pushes),
+            }):
+                views.update()
+
+        results['update'] = self.time('update', ingest)
+
+        # the same, as a gzipped NDJSON push to /api/update/bulk
+        pushes = iter(pushes_bulk)
+
+        def ingest_bulk():
+            body = gzip.compress(b"".join(json.dumps(m).encode() + b"\n" for m in next(pushes)))
+            with self.app.test_request_context('/api/update/bulk', method='POST', data=body, headers={
+                'X-Callback-Key': CALLBACK_KEY,
+                'Content-Type': 'application/x-ndjson',
+                'Content-Encoding': 'gzip',
+            }):
+                views.bulk_update()
+
+        results['update_bulk'] = self.time('update_bulk', ingest_bulk)
+
+        return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT).decode().strip()
+    except Exception:
+        return None
+
+
+def print_results(results, baseline=None):
+    columns = ['p50', 'p90', 'p99', 'mean', 'redis_roundtrips', 'redis_commands']
+    print("%-30s" % "benchmark" + "".join("%17s" % c for c in columns))
+    for name, result in results.items():
+        line = "%-30s" % name + "".join("%17.2f" % result[c] for c in columns)
+        if baseline and name in baseline:
+            before = baseline[name]['p50']
+            line += "   p50 %+.1f%%" % ((result['p50'] - before) / before * 100 if before else 0)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--redis-url', default="redis://localhost:6379/15")
+    parser.add_argument('--fakeredis', action='store_true', help="use an in-memory redis stand-in")
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--machines', type=int, default=60, help="machines per room")
+    parser.add_argument('--occupancy', type=float, default=0.6, help="share of machines in use")
+    parser.add_argument('--population', type=int, default=2000, help="number of distinct students")
+    parser.add_argument('--friends', type=int, default=20, help="friends of the benchmarking user")
+    parser.add_argument('--cascaders', type=int, default=30)
+    parser.add_argument('--churn', type=float, default=0.1, help="share of machines changing per push")
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--compare', help="JSON file from an earlier run to compare against")
+    args = parser.parse_args()
+
+    bench = Bench(args)
+    bench.populate()
+    results = bench.run()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    print_results(results, baseline)
+
+    if args.output:
+        params = {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'redis_url')}
+        with open(args.output, 'w') as f:
+            json.dump({
+                'commit': git_commit(),
+                'time': time.time(),
+                'params': params,
+                'results': results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
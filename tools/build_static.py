@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Builds fingerprinted, precompressed copies of map/static for production.
+
+Every file is copied to map/static/dist/ with a hash of its content in its
+name (js/mapp.js -> js/mapp.<hash>.js), and text files also get .gz and,
+if the brotli package is installed, .br copies. url() references in CSS are
+rewritten to the fingerprinted names. manifest.json maps each original name
+to its fingerprinted one; templates find assets through it (static_url in
+map/assets.py), and the app serves dist/ itself with year-long cache headers.
+
+Run it again whenever anything in map/static changes.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+
+ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "map", "static")
+DIST = "dist"
+MANIFEST = "manifest.json"
+
+COMPRESSIBLE = (".js", ".css", ".svg", ".html", ".json", ".txt")
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+
+def sources(root):
+    """Yields every asset's path relative to root, leaving out the build itself"""
+    for directory, dirs, files in os.walk(root):
+        if directory == root and DIST in dirs:
+            dirs.remove(DIST)
+        dirs.sort()
+        for name in sorted(files):
+            yield os.path.relpath(os.path.join(directory, name), root).replace(os.sep, "/")
+
+
+def fingerprint(name, content):
+    stem, ext = os.path.splitext(name)
+    return "%s.%s%s" % (stem, hashlib.sha256(content).hexdigest()[:12], ext)
+
+
+def rewrite_css(name, content, manifest, url_path):
+    """Points url()s in a stylesheet at the fingerprinted assets"""
+    def replace(match):
+        quote, url = match.groups()
+        if url.startswith(url_path + "/"):
+            target = url[len(url_path) + 1:]
+        elif "://" in url or url.startswith(("/", "data:")):
+            return match.group(0)
+        else:
+            target = os.path.normpath(os.path.join(os.path.dirname(name), url)).replace(os.sep, "/")
+
+        if target not in manifest:
+            return match.group(0)
+        return "url(%s%s/%s/%s%s)" % (quote, url_path, DIST, manifest[target], quote)
+
+    return CSS_URL.sub(replace, content.decode("utf-8")).encode("utf-8")
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def compressed_copies(path, content):
+    """Writes .gz (and .br) copies of a file, where they are smaller. Returns their count."""
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+
+    # mtime=0 keeps rebuilds of unchanged files byte for byte identical
+    copies = [(".gz", gzip.compress(content, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        copies.append((".br", brotli.compress(content, quality=11)))
+
+    count = 0
+    for suffix, data in copies:
+        if len(data) < len(content):
+            write(path + suffix, data)
+            count += 1
+    return count
+
+
+def build(root, url_path):
+    dist = os.path.join(root, DIST)
+    shutil.rmtree(dist, ignore_errors=True)
+
+    # stylesheets last, so the assets they refer to already have names
+    names = sorted(sources(root), key=lambda name: name.endswith(".css"))
+
+    manifest = {}
+    compressed = 0
+    for name in names:
+        with open(os.path.join(root, name), "rb") as f:
+            content = f.read()
+        if name.endswith(".css"):
+            content = rewrite_css(name, content, manifest, url_path)
+
+        manifest[name] = fingerprint(name, content)
+        path = os.path.join(dist, manifest[name])
+        write(path, content)
+        if name.endswith(COMPRESSIBLE):
+            compressed += compressed_copies(path, content)
+
+    write(os.path.join(dist, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"))
+    return len(manifest), compressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--root", default=ROOT, help="static folder to build (default: map/static)")
+    parser.add_argument("--url-path", default="/static", help="URL the static folder is served at")
+    args = parser.parse_args()
+
+    count, compressed = build(args.root, args.url_path.rstrip("/"))
+    print("Fingerprinted %d assets (%d precompressed copies) into %s" % (count, compressed, os.path.join(args.root, DIST)))
+
+
+if __name__ == "__main__":
+    main()
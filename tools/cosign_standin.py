@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""
+A local stand-in for the CoSign check service, for development and testing.
+
+Any non-empty cookie is accepted and treated as the uun of the user, so
+setting the cosign-betterinformatics.com cookie to `s1234567` logs you in as
+s1234567. Cookies starting with `bad` are rejected, and cookies starting with
+`ext-` belong to a realm other than INF.ED.AC.UK.
+
+Point COSIGN_CHECK_URL at http://localhost:<port>/check/ to use it.
+"""
+import argparse
+import json
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class CheckHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        cookie = parse_qs(url.query).get('cookie', [''])[0]
+
+        if not url.path.startswith('/check/') or not cookie or cookie.startswith('bad'):
+            body = {'status': 'fail'}
+        else:
+            body = {
+                'status': 'success',
+                'data': {
+                    'Principal': cookie,
+                    'Realm': 'EXAMPLE.COM' if cookie.startswith('ext-') else 'INF.ED.AC.UK',
+                },
+            }
+
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', type=int, default=6663)
+    args = parser.parse_args()
+
+    HTTPServer(('localhost', args.port), CheckHandler).serve_forever()
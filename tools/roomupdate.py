@@ -1,50 +1,27 @@
 #!/usr/bin/env python
+"""
+Loads one room's layout from a CSV sheet (in the same format as the deploy
+script's sheets: a site,key,name header, the room, a blank row, then the
+machine grid) through /api/update_schema, replacing just that room.
+"""
 import argparse
 
-import csv
-import sys
-
-from redis import Redis
+import requests
 
 parser = argparse.ArgumentParser()
-parser.add_argument('room')
 parser.add_argument('file')
-parser.add_argument('-k', '--redis-key', dest='authkey')
+parser.add_argument('-u', '--url', default="http://localhost:9000", help="where the app is running")
+parser.add_argument('-k', '--callback-key', dest='key', required=True)
 
 args = parser.parse_args()
 
-if args.authkey:
-    r = Redis().from_url("redis://:{}@localhost/0".format(args.authkey))
-else:
-    r = Redis()
-
-machines = set()
-
 with open(args.file, 'r') as placecsv:
-    preader = csv.reader(placecsv)
-
-    for rownumber, row in enumerate(preader):
-        if rownumber < 3:
-            continue
-        for colnumber, machine in enumerate(row):
-            print(rownumber, colnumber, machine)
-            machines.add(machine)
-            
-            r.hmset(machine, {
-                'hostname': machine,
-                'col': colnumber,
-                'row': rownumber-3,
-                'user': '',
-                'timestamp': '',
-                'status': 'offline',
-            })
-    machines.add("")
-
-machines.remove("")
-
-# empty the list
-machines_key = "{}-machines".format(args.room) 
-r.delete(machines_key)
-for machine in machines:
-    r.lpush(machines_key, machine)
-
+    sheet = placecsv.read().replace('\r\n', '\n').replace('\n', '\r\n')
+
+r = requests.post(args.url + "/api/update_schema", json={
+    'callback-key': args.key,
+    'machines': [{'name': args.file, 'csv': sheet}],
+    'resetAll': False,
+    'dropOnly': False,
+})
+print(r.status_code, r.text)